@@ -0,0 +1,300 @@
+"""
+Admission control in front of the upstream LLM calls, so one fast typist or a burst of participants cannot use up
+the provider's rate limit and cause 429s for everyone:
+
+- a token bucket on requests and on tokens per minute, set a little under the provider's RPM / TPM limits, so a
+  burst waits here instead of failing upstream. The buckets are per process; the app gives each worker its share
+- at most `per_session` interactive completions in flight per session. A request still waiting for its turn is dropped
+  when a newer one from the same session arrives, since its text is out of date. A call that is already running
+  keeps its slot until it is released, also when the app has abandoned it, since the provider is still working on it
+- waiting calls are admitted in priority order: interactive autocomplete, persona setup, speculative and background
+  work, then batch jobs
+- a call that cannot start at least `min_remaining_seconds` before its deadline is shed right away, so the editor
+  gets a fast empty answer instead of a late one
+"""
+
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+from metrics import ADMISSION_WAIT_SECONDS
+
+INTERACTIVE = 0
+PERSONA = 1
+SPECULATIVE = 2
+BATCH = 3
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', PERSONA: 'persona', SPECULATIVE: 'speculative', BATCH: 'batch'}
+
+_PARKED, _QUEUED, _ADMITTED, _SHED = range(4)
+
+
+class AdmissionRejected(Exception):
+    """The call was shed: it could not start before its deadline, or a newer request from its session replaced it."""
+
+
+class TokenBucket:
+    def __init__(self, per_minute, burst_seconds=5):
+        self.rate = per_minute / 60
+        self.capacity = max(self.rate * burst_seconds, 1)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount):
+        """Seconds until `amount` is available. An amount above the capacity waits for a full bucket."""
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+
+class Ticket:
+    """An admitted call. Release it (or use it as a context manager) when the call is done."""
+
+    def __init__(self, controller=None, waiter=None):
+        self._controller = controller
+        self._waiter = waiter
+
+    def release(self):
+        if self._controller is not None:
+            self._controller._release(self._waiter)
+            self._controller = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class _Waiter:
+    __slots__ = ('priority', 'seq', 'tokens', 'deadline', 'sid', 'wake', 'state', 'reason', 'queued_at')
+
+    def __init__(self, priority, seq, tokens, deadline, sid, wake):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.deadline = deadline
+        self.sid = sid
+        self.wake = wake
+        self.state = _PARKED
+        self.reason = None
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController:
+    """
+    `requests_per_minute` / `tokens_per_minute` of 0 leave that limit off. Deadlines are `time.monotonic()` values.
+    Only calls made with a `sid` count against the per-session limit.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, burst_seconds=5, per_session=1,
+                 min_remaining_seconds=0.3, enabled=True):
+        self.requests = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self.per_session = per_session
+        self.min_remaining_seconds = min_remaining_seconds
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._queue = []  # heap of queued waiters; shed ones are skipped lazily
+        self._seq = itertools.count()
+        self._in_flight = {}  # sid -> admitted (or queued) calls holding a session slot
+        self._waiting = {}  # sid -> the session's waiter that has not been admitted yet
+        self.admitted = 0
+        self.shed = 0
+        self.superseded = 0
+        self.cancelled = 0
+        self.extra_denied = 0
+
+    def admit(self, priority, tokens=0, deadline=None, sid=None):
+        """Block until the call may start. Returns a Ticket. Raises AdmissionRejected."""
+        if not self.enabled:
+            return Ticket()
+        event = threading.Event()
+        waiter = self._enqueue(priority, tokens, deadline, sid, event.set)
+        while True:
+            admitted, delay = self._poll(waiter)
+            if admitted:
+                return Ticket(self, waiter)
+            event.wait(delay)
+            event.clear()
+
+    async def aadmit(self, priority, tokens=0, deadline=None, sid=None):
+        """Async version of `admit`. A cancelled wait gives up its place in the queue."""
+        if not self.enabled:
+            return Ticket()
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = self._enqueue(priority, tokens, deadline, sid, lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            while True:
+                admitted, delay = self._poll(waiter)
+                if admitted:
+                    return Ticket(self, waiter)
+                try:
+                    await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.state != _ADMITTED:
+                    self._drop(waiter, None)
+            raise
+
+    def try_admit(self, priority, tokens=0):
+        """
+        Admit an optional extra call (a hedge or a retry) only if the buckets have room now and nothing of the same or
+        higher priority is waiting. Never waits, and takes no session slot.
+        """
+        if not self.enabled:
+            return True
+        with self._lock:
+            self._refill(time.monotonic())
+            head = self._head()
+            if (head is not None and head.priority <= priority) or self._bucket_wait(tokens) > 0:
+                self.extra_denied += 1
+                return False
+            self._take(tokens)
+            return True
+
+    def cancel(self, sid):
+        """Shed the session's call that is still waiting to be admitted, if any, e.g. because the user typed on."""
+        if not self.enabled:
+            return
+        with self._lock:
+            waiter = self._waiting.get(sid)
+            if waiter is not None:
+                self.cancelled += 1
+                self._drop(waiter, 'cancelled by the client')
+
+    def stats(self):
+        with self._lock:
+            return {'admitted': self.admitted, 'shed': self.shed, 'superseded': self.superseded,
+                    'cancelled': self.cancelled, 'extra_denied': self.extra_denied, 'waiting': len(self._waiting),
+                    'queued': sum(waiter.state == _QUEUED for waiter in self._queue)}
+
+    def _enqueue(self, priority, tokens, deadline, sid, wake):
+        with self._lock:
+            waiter = _Waiter(priority, next(self._seq), tokens, deadline, sid, wake)
+            if sid is not None:
+                older = self._waiting.get(sid)
+                if older is not None:
+                    self.superseded += 1
+                    self._drop(older, 'superseded by a newer request from the session')
+                self._waiting[sid] = waiter
+                if self._in_flight.get(sid, 0) >= self.per_session:
+                    return waiter  # Parked until the session's call in flight is released
+                self._in_flight[sid] = self._in_flight.get(sid, 0) + 1
+            waiter.state = _QUEUED
+            heapq.heappush(self._queue, waiter)
+            return waiter
+
+    def _poll(self, waiter):
+        """(True, None) once `waiter` is admitted, otherwise (False, seconds to sleep unless woken, or None)."""
+        with self._lock:
+            if waiter.state == _SHED:
+                raise AdmissionRejected(waiter.reason)
+            now = time.monotonic()
+            latest_start = waiter.deadline - self.min_remaining_seconds if waiter.deadline is not None else None
+            wait = None
+            if waiter.state == _QUEUED:
+                self._refill(now)
+                if self._head() is waiter:
+                    wait = self._bucket_wait(waiter.tokens)
+                    if wait == 0:
+                        self._admit(waiter, now)
+                        return True, None
+                elif latest_start is not None and self.requests is not None:
+                    # Everything queued ahead has to be admitted first, at the request rate
+                    ahead = sum(other.state == _QUEUED and other < waiter for other in self._queue)
+                    wait = max(0.0, (ahead + 1 - self.requests.level) / self.requests.rate)
+            if latest_start is not None and now + (wait or 0) > latest_start:
+                self._drop(waiter, 'would not start before its deadline')
+                raise AdmissionRejected(waiter.reason)
+            if latest_start is not None and (wait is None or waiter.state != _QUEUED or self._head() is not waiter):
+                return False, latest_start - now  # Wake up to shed at the deadline unless woken before
+            return False, wait
+
+    def _admit(self, waiter, now):
+        heapq.heappop(self._queue)
+        self._take(waiter.tokens)
+        waiter.state = _ADMITTED
+        if waiter.sid is not None and self._waiting.get(waiter.sid) is waiter:
+            del self._waiting[waiter.sid]
+        self.admitted += 1
+        ADMISSION_WAIT_SECONDS.observe(now - waiter.queued_at, PRIORITY_NAMES.get(waiter.priority, waiter.priority))
+        self._wake_head()
+
+    def _release(self, waiter):
+        with self._lock:
+            self._free_slot(waiter.sid)
+
+    def _drop(self, waiter, reason):
+        """Take a waiting call out of the queue; with a `reason` it counts as shed and is woken to raise."""
+        was_queued = waiter.state == _QUEUED
+        waiter.state = _SHED
+        waiter.reason = reason
+        if waiter.sid is not None and self._waiting.get(waiter.sid) is waiter:
+            del self._waiting[waiter.sid]
+        if was_queued:
+            self._free_slot(waiter.sid)
+        if reason is not None:
+            self.shed += 1
+            waiter.wake()
+        self._wake_head()
+
+    def _free_slot(self, sid):
+        if sid is None:
+            return
+        self._in_flight[sid] -= 1
+        if not self._in_flight[sid]:
+            del self._in_flight[sid]
+        parked = self._waiting.get(sid)
+        if parked is not None and parked.state == _PARKED:
+            self._in_flight[sid] = self._in_flight.get(sid, 0) + 1
+            parked.state = _QUEUED
+            heapq.heappush(self._queue, parked)
+            parked.wake()
+
+    def _head(self):
+        while self._queue and self._queue[0].state != _QUEUED:
+            heapq.heappop(self._queue)
+        return self._queue[0] if self._queue else None
+
+    def _wake_head(self):
+        head = self._head()
+        if head is not None:
+            head.wake()
+
+    def _refill(self, now):
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.refill(now)
+
+    def _bucket_wait(self, tokens):
+        wait = 0.0
+        if self.requests is not None:
+            wait = self.requests.wait_for(1)
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.wait_for(tokens))
+        return wait
+
+    def _take(self, tokens):
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None and tokens:
+            self.tokens.take(tokens)
+
+
+def estimate_tokens(messages, max_tokens=0, n=1):
+    """Rough token count of a call for the tokens-per-minute bucket: about 4 characters per prompt token."""
+    return sum(len(message.get('content') or '') for message in messages) // 4 + (max_tokens or 0) * (n or 1)
@@ -6,21 +6,90 @@ Description: This file contains the main Flask app that handles the autocomplete
 the app autocompletes the user's response as if this specific user experienced a specific event.
 """
 
+import functools
 import json
+import os
 import random
-import re
-import string
-from litellm import completion
-from concurrent.futures import ThreadPoolExecutor
-
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-
+import time
+import uuid
+from types import SimpleNamespace
+
+from flask import Flask, Response, render_template, request, redirect, url_for, session, flash, jsonify, \
+    stream_with_context
+
+import persona_setup
+from admission import INTERACTIVE, PERSONA, SPECULATIVE, AdmissionController, AdmissionRejected, estimate_tokens
+from llm import completion
+from completion_cache import CompletionCache, NO_SPACE_BEFORE
+from context_window import ContextWindow, summarize_story
 from config import AppConfig
+from candidates import CandidateStore
+from dispatch import CircuitBreaker, CompletionDispatcher, n_choices
+from documents import DocumentStore, DocumentVersionMismatch
+from fallback import FallbackEngine
 from forms import CharacterForm, EventForm
+from text_processing import (normalize_spacing, get_context_and_incomplete_sentence, postprocess_completion,
+                             rank_candidates, stream_complete_words, CompleteWordStream)
+from inflight import InflightTracker
+from persona_jobs import DONE, PersonaJobQueue, PersonaJobsBusy
+from metrics import REGISTRY, CONTENT_TYPE, LLM_ERRORS, Profiler, StageTimer, instrumented
+from request_log import RequestLogger
+from sessions import ServerSideSessionInterface
+from speculation import SpeculativePrefetcher
+from stores import open_store
 
 app = Flask(__name__)
-app_config = AppConfig()
+app_config = AppConfig(os.getenv('AUTOCOMPLETE_CONFIG', 'config.yaml'))
 app.config['SECRET_KEY'] = app_config.flask_secret_key
+session_store = open_store(app_config.session_store_url)
+app.session_interface = ServerSideSessionInterface(session_store, ttl_seconds=app_config.session_ttl_seconds)
+persona_jobs = PersonaJobQueue(store=session_store, max_workers=app_config.persona_jobs_max_workers,
+                               max_pending=app_config.persona_jobs_max_pending,
+                               ttl_seconds=app_config.persona_jobs_ttl_seconds)
+inflight = InflightTracker(max_workers=app_config.max_upstream_workers)
+completion_cache = CompletionCache(
+    max_entries=app_config.cache_max_entries, ttl_seconds=app_config.cache_ttl_seconds,
+    enabled=app_config.cache_enabled,
+    shared=open_store(app_config.shared_cache_url) if app_config.shared_cache_url else None)
+documents = DocumentStore(max_sessions=app_config.max_documents)
+candidate_store = CandidateStore(max_sessions=app_config.max_documents)
+fallback = FallbackEngine(max_personas=app_config.fallback_max_personas,
+                          max_vocabulary=app_config.fallback_max_vocabulary, max_words=app_config.fallback_max_words,
+                          enabled=app_config.fallback_enabled)
+prefetcher = SpeculativePrefetcher(max_calls_per_session=app_config.speculative_max_calls_per_session,
+                                   max_workers=app_config.speculative_max_workers,
+                                   enabled=app_config.speculative_enabled)
+context_window = ContextWindow(
+    summarize=lambda previous_summary, new_text: summarize_story_admitted(previous_summary, new_text),
+    model=app_config.model, max_prompt_tokens=app_config.context_max_prompt_tokens,
+    verbatim_sentences=app_config.context_verbatim_sentences,
+    summarize_every_sentences=app_config.context_summarize_every_sentences, enabled=app_config.context_window_enabled)
+profiler = Profiler(sample_rate=app_config.profile_sample_rate, directory=app_config.profile_dir)
+request_log = RequestLogger(path=app_config.request_log_path, batch_size=app_config.request_log_batch_size,
+                            flush_interval=app_config.request_log_flush_interval,
+                            max_queue=app_config.request_log_max_queue, enabled=app_config.request_log_enabled)
+admission = AdmissionController(
+    requests_per_minute=app_config.admission_requests_per_minute,
+    tokens_per_minute=app_config.admission_tokens_per_minute, burst_seconds=app_config.admission_burst_seconds,
+    per_session=app_config.admission_per_session, min_remaining_seconds=app_config.admission_min_remaining_seconds,
+    enabled=app_config.admission_enabled)
+dispatcher = CompletionDispatcher(
+    deadline_seconds=app_config.dispatch_deadline_seconds, hedge_percentile=app_config.dispatch_hedge_percentile,
+    hedge_default_delay=app_config.dispatch_hedge_default_delay, hedge_model=app_config.dispatch_hedge_model,
+    max_retries=app_config.max_attempts, backoff_base=app_config.dispatch_backoff_base,
+    breaker=CircuitBreaker(failure_threshold=app_config.dispatch_breaker_failure_threshold,
+                           reset_seconds=app_config.dispatch_breaker_reset_seconds),
+    admission=admission, max_workers=app_config.dispatch_max_workers, log=request_log.log)
+REGISTRY.register_stats('autocomplete_admission', admission.stats)
+REGISTRY.register_stats('autocomplete_dispatch', dispatcher.stats)
+REGISTRY.register_stats('autocomplete_inflight', inflight.stats)
+REGISTRY.register_stats('autocomplete_candidates', candidate_store.stats)
+REGISTRY.register_stats('autocomplete_completion_cache', completion_cache.stats)
+REGISTRY.register_stats('autocomplete_fallback', fallback.stats)
+REGISTRY.register_stats('autocomplete_speculative', prefetcher.stats)
+REGISTRY.register_stats('autocomplete_persona_cache', app_config.persona_cache.stats)
+REGISTRY.register_stats('autocomplete_persona_jobs', persona_jobs.stats)
+REGISTRY.register_stats('autocomplete_request_log', request_log.stats)
 
 
 @app.route('/')
@@ -47,43 +116,365 @@ def initial():
 
 
 @app.route('/index')
+@instrumented('index', profiler)
 def index():
     '''Returns rendered template'''
+    get_session_id()
+    job_id = session.get('persona_job')
+    if job_id is not None:
+        job = persona_jobs.get(job_id)
+        if job is not None:
+            apply_persona_job(job_id, job)
     return render_template('index.html',
                            debounce_time=app_config.debounce_time,
+                           debounce_settings={'adaptive': app_config.adaptive_debounce, 'min': app_config.debounce_min,
+                                              'max': app_config.debounce_max,
+                                              'typing_factor': app_config.debounce_typing_factor,
+                                              'latency_factor': app_config.debounce_latency_factor},
+                           min_new_characters=app_config.min_new_characters,
                            min_sentences=app_config.min_sentences,
                            stuck_prompts=app_config.stuck_prompts,
-                           predicted_event=session['predicted_event'])
+                           stream=app_config.stream,
+                           predicted_event=session.get('predicted_event') or '',
+                           persona_job=session.get('persona_job'),
+                           persona_poll_interval=app_config.persona_jobs_poll_interval)
 
 
 @app.route('/autocomplete', methods=['GET', 'POST'])
+@instrumented('autocomplete', profiler)
 def autocomplete():
     """ Handle the autocomplete request. """
-    text = normalize_spacing(request.json.get('text'))
+    timer = StageTimer('autocomplete')
+    sid = get_session_id()
+    try:
+        with timer('split'):
+            text, (context, incomplete_sentence), doc_version = resolve_document(sid, request.json)
+    except DocumentVersionMismatch as e:
+        return jsonify(error='version_mismatch', doc_version=e.version), 409
+    client_request_id = request.json.get('request_id')
+    with timer('prompt'):
+        completion_kwargs, prompt_tokens = prepare_completion_kwargs(sid, context, incomplete_sentence, session)
+    cached = get_cached_completion(completion_kwargs)
+    if cached is not None:
+        inflight.supersede(sid)
+        candidate_store.put(sid, (context, incomplete_sentence), [cached])
+        speculate_next_completion(sid, session, context, incomplete_sentence, cached)
+        with timer('serialize'):
+            response = jsonify(completion=cached, request_id=client_request_id, stale=False, doc_version=doc_version,
+                               prompt_tokens=0, candidates=1)
+        request_log.log({'endpoint': 'autocomplete', 'text': text, 'context': context,
+                         'incomplete_sentence': incomplete_sentence, 'cached': cached, 'timings_ms': timer.ms})
+        return response
+    with timer('upstream'):
+        _, completions, stale = inflight.run(sid, get_chat_completions, client_request_id=client_request_id,
+                                             n=app_config.candidates, session_id=sid, **completion_kwargs)
+    if stale:
+        # A newer request from this session arrived, so the user has already changed the text
+        return jsonify(completion='', request_id=client_request_id, stale=True, doc_version=doc_version,
+                       prompt_tokens=prompt_tokens)
+    with timer('postprocess'):
+        completion = normalize_spacing(completions[0] if completions else None)
+        d = {'text': text, 'context': context, 'incomplete_sentence': incomplete_sentence,
+             'prompt_context': completion_kwargs['context'], 'prompt_tokens': prompt_tokens,
+             'include_event': completion_kwargs['include_event'],
+             **postprocess_completion(incomplete_sentence, completion),
+             'candidates': store_candidates(sid, context, incomplete_sentence, completions or [])}
+    suggestion = d['candidates'][0] if d['candidates'] else ''
+    cache_completion(completion_kwargs, suggestion)
+    speculate_next_completion(sid, session, context, incomplete_sentence, suggestion)
+    if not suggestion:
+        suggestion = d['fallback'] = fallback_completion(sid, session, context, incomplete_sentence)
+    with timer('serialize'):
+        response = jsonify(completion=suggestion, request_id=client_request_id, stale=False, doc_version=doc_version,
+                           prompt_tokens=prompt_tokens, candidates=len(d['candidates']) or int(bool(suggestion)),
+                           fallback=bool(d.get('fallback')))
+    request_log.log({'endpoint': 'autocomplete', **d, 'timings_ms': timer.ms})
+    return response
+
+
+@app.route('/autocomplete/stream', methods=['POST'])
+@instrumented('autocomplete_stream', profiler)
+def autocomplete_stream():
+    """
+    Streaming version of /autocomplete. Pushes Server-Sent Events to the editor:
+
+    - with `fallback.show_while_waiting`, a `provisional` event first carries the local fallback suggestion, shown
+      until the first `word` event replaces it
+    - `word` events carry the newly completed words (`delta`) as soon as the LLM emits a word boundary
+    - a final `done` event carries the fully post-processed completion, which is authoritative, and the number of
+      candidates that /autocomplete/next can cycle through. If the LLM gave no suggestion, it is the local fallback's
+      (`fallback` is true)
+    - a `stale` event is sent instead if a newer request from the same session supersedes this one, and the
+      upstream stream is closed
+    """
+    timer = StageTimer('autocomplete_stream')
+    sid = get_session_id()
+    try:
+        with timer('split'):
+            text, (context, incomplete_sentence), doc_version = resolve_document(sid, request.json)
+    except DocumentVersionMismatch as e:
+        return jsonify(error='version_mismatch', doc_version=e.version), 409
+    client_request_id = request.json.get('request_id')
+    with timer('prompt'):
+        completion_kwargs, prompt_tokens = prepare_completion_kwargs(sid, context, incomplete_sentence, session)
+    request_id = inflight.begin(sid, client_request_id=client_request_id)
+    cached = get_cached_completion(completion_kwargs)
+
+    def generate():
+        if cached is not None:
+            inflight.finish(sid, request_id)
+            candidate_store.put(sid, (context, incomplete_sentence), [cached])
+            yield format_sse('done', {'completion': cached, 'request_id': client_request_id, 'candidates': 1})
+            speculate_next_completion(sid, session, context, incomplete_sentence, cached)
+            request_log.log({'endpoint': 'autocomplete_stream', 'text': text, 'context': context,
+                             'incomplete_sentence': incomplete_sentence, 'cached': cached, 'timings_ms': timer.ms})
+            return
+        if app_config.fallback_show_while_waiting:
+            provisional = fallback.suggest(session, incomplete_sentence)
+            if provisional:
+                yield format_sse('provisional', {'completion': provisional, 'request_id': client_request_id})
+        raw = ''
+        other_choices = {}
+        try:
+            # Includes the incremental post-processing and the time the client takes to read each word
+            with timer('upstream'):
+                chunks = stream_chat_completion(n=app_config.candidates, other_choices=other_choices,
+                                                session_id=sid, **completion_kwargs)
+                for delta, raw in stream_complete_words(incomplete_sentence, chunks):
+                    if not inflight.is_current(sid, request_id):
+                        yield format_sse('stale', {'request_id': client_request_id})
+                        return
+                    if delta:
+                        yield format_sse('word', {'delta': delta, 'request_id': client_request_id})
+        finally:
+            inflight.finish(sid, request_id)
+        with timer('postprocess'):
+            d = {'text': text, 'context': context, 'incomplete_sentence': incomplete_sentence,
+                 'prompt_context': completion_kwargs['context'], 'prompt_tokens': prompt_tokens,
+                 'include_event': completion_kwargs['include_event'],
+                 **postprocess_completion(incomplete_sentence, normalize_spacing(raw))}
+            d['candidates'] = store_candidates(sid, context, incomplete_sentence, [raw, *other_choices.values()],
+                                               shown=d['de_duped_completion'])
+        suggestion = d['candidates'][0] if d['candidates'] else ''
+        cache_completion(completion_kwargs, suggestion)
+        if not suggestion:
+            suggestion = d['fallback'] = fallback_completion(sid, session, context, incomplete_sentence)
+        with timer('serialize'):
+            done = format_sse('done', {'completion': suggestion, 'request_id': client_request_id,
+                                       'prompt_tokens': prompt_tokens,
+                                       'candidates': len(d['candidates']) or int(bool(suggestion)),
+                                       'fallback': bool(d.get('fallback'))})
+        yield done
+        speculate_next_completion(sid, session, context, incomplete_sentence, suggestion)
+        request_log.log({'endpoint': 'autocomplete_stream', **d, 'timings_ms': timer.ms})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/autocomplete/speculative', methods=['POST'])
+@instrumented('autocomplete_speculative', profiler)
+def autocomplete_speculative():
+    """
+    Called by the editor right after a Tab-accept. Serves the completion that was prefetched for the accepted
+    text, if there is one. `hit` is false when there was nothing to serve and the editor should fall back to its
+    normal debounced request. The `accepted` suggestion trains the session's fallback model.
+    """
+    sid = get_session_id()
+    try:
+        text, (context, incomplete_sentence), doc_version = resolve_document(sid, request.json)
+    except DocumentVersionMismatch as e:
+        return jsonify(error='version_mismatch', doc_version=e.version), 409
+    client_request_id = request.json.get('request_id')
+    learn_accepted(session, text, request.json.get('accepted'))
+    inflight.supersede(sid)
+    completion = prefetcher.take(sid, (context, incomplete_sentence))
+    if completion:
+        candidate_store.put(sid, (context, incomplete_sentence), [completion])
+        speculate_next_completion(sid, session, context, incomplete_sentence, completion)
+    return jsonify(completion=completion or '', request_id=client_request_id, stale=False, hit=bool(completion),
+                   doc_version=doc_version)
+
+
+@app.route('/autocomplete/next', methods=['POST'])
+@instrumented('autocomplete_next', profiler)
+def autocomplete_next():
+    """
+    Cycles to the next candidate for the current text (the previous one with `step: -1`) without an LLM call. `hit`
+    is false when no candidates are stored for the text, and `position` / `candidates` say where the cycle is.
+    """
+    sid = get_session_id()
+    try:
+        _, (context, incomplete_sentence), doc_version = resolve_document(sid, request.json)
+    except DocumentVersionMismatch as e:
+        return jsonify(error='version_mismatch', doc_version=e.version), 409
+    client_request_id = request.json.get('request_id')
+    step = -1 if request.json.get('step', 1) < 0 else 1
+    result = candidate_store.cycle(sid, (context, incomplete_sentence), step)
+    if result is None:
+        return jsonify(completion='', request_id=client_request_id, stale=False, hit=False, doc_version=doc_version)
+    completion, position, count = result
+    return jsonify(completion=completion, request_id=client_request_id, stale=False, hit=True, position=position,
+                   candidates=count, doc_version=doc_version)
+
+
+@app.route('/autocomplete/cancel', methods=['POST'])
+@instrumented('autocomplete_cancel', profiler)
+def autocomplete_cancel():
+    """
+    Sent by the editor (as a beacon) when the text changes while a suggestion is still on its way. If the session's
+    request in flight is still the one with this `request_id`, its LLM call is cancelled or abandoned, or it leaves
+    the admission queue, instead of finishing for a text the user no longer has. An abandoned call keeps the
+    session's admission slot until it returns, since the provider is still working on it.
+    """
+    sid = get_session_id()
+    if inflight.cancel(sid, (request.get_json(silent=True) or {}).get('request_id')):
+        admission.cancel(sid)
+    return '', 204
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics for this process."""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+def get_session_id():
+    """Stable id for the browser session, used to key server-side per-session state."""
+    if 'sid' not in session:
+        session['sid'] = uuid.uuid4().hex
+    return session['sid']
+
+
+def resolve_document(sid, payload):
+    """
+    The editor sends either the full `text`, or a `delta` ({base_version, offset, delete, insert}) against the
+    server's copy of the session's document. Returns (text, (context, incomplete sentence), document version).
+
+    Raises DocumentVersionMismatch if the delta does not apply to the server's copy; the editor then resends the
+    full text.
+    """
+    delta = payload.get('delta')
+    if delta is None:
+        return documents.reset(sid, payload.get('text') or '')
+    return documents.apply(sid, delta['base_version'], delta['offset'], delta['delete'], delta['insert'])
+
+
+def split_text(text):
+    """Normalized (context, incomplete sentence) for a full text."""
     context, incomplete_sentence = get_context_and_incomplete_sentence(normalize_spacing(text))
-    context, incomplete_sentence = normalize_spacing(context), normalize_spacing(incomplete_sentence)
+    return normalize_spacing(context), normalize_spacing(incomplete_sentence)
+
+
+def prepare_completion_kwargs(sid, context, incomplete_sentence, persona):
+    """
+    Sample the per-request LLM settings and fit the context into the prompt token budget. `persona` is the session,
+    or any mapping with the same character and event keys. `sid` is None for a one-off request, such as a batch
+    record (see ContextWindow.build). Returns (kwargs for `get_chat_completion`, prompt tokens).
+    """
     include_event = random.random() <= app_config.event_relevant
-    print("INCLUDE EVENT", include_event)
     if include_event:
         temperature = app_config.temperature_range[0]
     else:
         temperature = random.uniform(*app_config.temperature_range)
-    completion = normalize_spacing(
-        get_chat_completion(character_description=session['character_description'], event=session['event_name'],
-                            event_effects=session['event_description'],
-                            include_event=include_event, model=app_config.model,
-                            context=context, incomplete_sentence=incomplete_sentence,
-                            temperature=temperature,
-                            frequency_penalty=app_config.frequency_penalty,
-                            max_tokens=random.randint(*app_config.token_range)))
-    completion_no_prompt = remove_prompt_words(completion)
-    full_word_completion = normalize_spacing(extract_complete_words(completion_no_prompt))
-    de_duped_completion = normalize_spacing(remove_duplicated_completion(incomplete_sentence, full_word_completion))
-    d = {'text': text, 'context': context, 'incomplete_sentence': incomplete_sentence, 'completion': completion,
-         'full_word_completion': full_word_completion, 'de_duped_completion': de_duped_completion,
-         'completion_no_prompt': completion_no_prompt}
-    print(d)
-    return jsonify(completion=de_duped_completion)
+    completion_kwargs = dict(character_description=persona['character_description'], event=persona['event_name'],
+                             event_effects=persona['event_description'],
+                             include_event=include_event, model=app_config.model,
+                             context='', incomplete_sentence=incomplete_sentence,
+                             temperature=temperature,
+                             frequency_penalty=app_config.frequency_penalty,
+                             max_tokens=random.randint(*app_config.token_range))
+    fixed_tokens = context_window.count_message_tokens(build_completion_messages(
+        character_description=persona['character_description'], event=persona['event_name'],
+        event_effects=persona['event_description'], context='', incomplete_sentence=incomplete_sentence,
+        include_event=include_event))
+    completion_kwargs['context'], context_tokens = context_window.build(sid, context, fixed_tokens,
+                                                                        documents.sentences(sid, context))
+    return completion_kwargs, fixed_tokens + context_tokens
+
+
+def speculate_next_completion(sid, persona, context, incomplete_sentence, de_duped_completion):
+    """Start generating the suggestion that follows if the user accepts `de_duped_completion`."""
+    if not de_duped_completion:
+        return
+    accepted = split_after_accept(context, incomplete_sentence, de_duped_completion)
+    completion_kwargs, _ = prepare_completion_kwargs(sid, *accepted, persona)
+    prefetcher.schedule(sid, accepted, generate_completion, completion_kwargs)
+
+
+def store_candidates(sid, context, incomplete_sentence, completions, shown=None):
+    """
+    Rank the raw `completions` of one request and store them for /autocomplete/next. `shown`, a suggestion the editor
+    already displays (streamed), stays first. Returns the suggestions in order.
+    """
+    suggestions = rank_candidates(incomplete_sentence, completions)
+    if shown:
+        suggestions = [shown] + [suggestion for suggestion in suggestions if suggestion.lower() != shown.lower()]
+    candidate_store.put(sid, (context, incomplete_sentence), suggestions)
+    return suggestions
+
+
+def fallback_completion(sid, persona, context, incomplete_sentence):
+    """
+    The local fallback's suggestion, for when the LLM gave none, stored as the only candidate. It is neither cached
+    nor speculated on, so the next request for the text goes to the LLM again.
+    """
+    suggestion = fallback.suggest(persona, incomplete_sentence)
+    candidate_store.put(sid, (context, incomplete_sentence), [suggestion] if suggestion else [])
+    return suggestion
+
+
+def learn_accepted(persona, text, accepted):
+    """Train the fallback model on a suggestion accepted with Tab. `text` is the full text after accepting it."""
+    accepted = normalize_spacing(accepted)
+    text = normalize_spacing(text)
+    if not accepted or not text.endswith(accepted) or not persona.get('character_description'):
+        return
+    fallback.learn(persona, split_text(text[:-len(accepted)])[1], accepted)
+
+
+def split_after_accept(context, incomplete_sentence, suggestion):
+    """
+    (context, incomplete sentence) of the text after the editor appends `suggestion` with Tab. Only the incomplete
+    sentence and the suggestion are re-split, since everything in `context` is already a complete sentence.
+    """
+    new_sentences, new_incomplete_sentence = split_text(join_suggestion(incomplete_sentence, suggestion))
+    return normalize_spacing(context + ' ' + new_sentences), new_incomplete_sentence
+
+
+def join_suggestion(text, suggestion):
+    """The text the editor ends up with when a suggestion is accepted with Tab."""
+    if not text or suggestion[0] in NO_SPACE_BEFORE:
+        return normalize_spacing(text + suggestion)
+    return normalize_spacing(text + ' ' + suggestion)
+
+
+def generate_completion(completion_kwargs, priority=SPECULATIVE):
+    """Cache lookup, LLM call and post-processing in one blocking call, for work done off the request path."""
+    cached = get_cached_completion(completion_kwargs)
+    if cached is not None:
+        return cached
+    completion = normalize_spacing(get_chat_completion(priority=priority, **completion_kwargs))
+    de_duped_completion = postprocess_completion(completion_kwargs['incomplete_sentence'],
+                                                 completion)['de_duped_completion']
+    cache_completion(completion_kwargs, de_duped_completion)
+    return de_duped_completion
+
+
+def get_cached_completion(completion_kwargs):
+    return completion_cache.get(completion_kwargs['character_description'], completion_kwargs['event'],
+                                completion_kwargs['include_event'], completion_kwargs['context'],
+                                completion_kwargs['incomplete_sentence'])
+
+
+def cache_completion(completion_kwargs, de_duped_completion):
+    completion_cache.put(completion_kwargs['character_description'], completion_kwargs['event'],
+                         completion_kwargs['include_event'], completion_kwargs['context'],
+                         completion_kwargs['incomplete_sentence'], de_duped_completion)
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 ############################################################
@@ -91,30 +482,21 @@ def autocomplete():
 ############################################################
 @app.route('/user_settings', methods=['GET', 'POST'])
 @app.route('/user_settings', methods=['GET', 'POST'])
+@instrumented('user_settings', profiler)
 def user_settings():
     character_form = CharacterForm()
     event_form = EventForm()
 
     if request.method == 'POST':
         if character_form.validate_on_submit() and event_form.validate_on_submit():
-            flash('Character and event created successfully!', 'success')
             character_description = construct_character_description(character_form)
             event_name = event_form.event.data
-
-            session['character_description'] = character_description
-            session['event_name'] = event_name
-
-            with ThreadPoolExecutor(max_workers=2) as executor:
-                future_dynamic_effects = executor.submit(get_dynamic_effects, character_description, event_name)
-                future_predicted_event = executor.submit(get_predicted_event, character_description, event_name)
-
-                event_description = future_dynamic_effects.result()
-                predicted_event = future_predicted_event.result()
-
-            session['event_description'] = event_description
-            session['predicted_event'] = predicted_event
-
-            return redirect(url_for('index'))
+            # The effects and predicted event are generated in the background; the editor waits for them
+            if start_persona_job(character_description, event_name, {
+                    'event_description': functools.partial(get_dynamic_effects, character_description, event_name),
+                    'predicted_event': functools.partial(get_predicted_event, character_description, event_name)}):
+                flash('Character and event created successfully!', 'success')
+                return redirect(url_for('index'))
         else:
             flash('Please correct the errors in the form.', 'error')
 
@@ -123,197 +505,177 @@ def user_settings():
 
 
 @app.route('/user_settings_experiment', methods=['GET', 'POST'])
+@instrumented('user_settings_experiment', profiler)
 def user_settings_experiment():
     character_form = CharacterForm()
     if request.method == 'POST':
         if character_form.validate_on_submit():
-            flash('Character created successfully!', 'success')
-            session['character_description'] = construct_character_description(character_form)
-            session['event_name'] = app_config.event['name']
-            session['event_description'] = get_dynamic_effects(session['character_description'],
-                                                               app_config.event['name'])
-            return redirect(url_for('index'))
+            character_description = construct_character_description(character_form)
+            event_name = app_config.event['name']
+            if start_persona_job(character_description, event_name, {
+                    'event_description': functools.partial(get_dynamic_effects, character_description, event_name)}):
+                flash('Character created successfully!', 'success')
+                return redirect(url_for('index'))
+            return render_template('user_settings_experiment.html', character_form=character_form)
         else:
             flash('Please correct the errors in the form.', 'error')
     elif request.method == 'GET':
         return render_template('user_settings_experiment.html', character_form=character_form)
 
 
-def get_predicted_event(character_description, event_name):
-    client = app_config.client
-    response = client.chat.completions.create(
-        model=app_config.effects_generator_model,
-        messages=[
-            {"role": "system", "content": "You are a helpful, factual, and highly specific assistant."},
-            {"role": "user", "content": (
-                f"INSTRUCTIONS\n"
-                f"Given a description of a person, return a realistic scenario that would cause this person to experience {event_name}. Rely ONLY on what is in the description."
-                f"Be very specific and very realistic. Do not exaggerate. Write 20-30 words. DO NOT write about the effect of this event, but only focus on the scenario and how "
-                f"that would make them experience {event_name}. Return one such event. Write in second person.\n"
-                f"DESCRIPTION:\n"
-                f"{character_description}"
-            )}
-        ],
-        temperature=0.6,
-        max_tokens=1000,
-        top_p=1
-    )
-    return json.loads(response.choices[0].json())['message']['content']
-
-
-def get_dynamic_effects(character_description, event_name, attempt_no=0, max_attempts=2):
-    if attempt_no > max_attempts:
-        return None
-    else:
-        try:
-            client = app_config.client
-            response = client.chat.completions.create(model=app_config.effects_generator_model, messages=[
-                {"role": "system", "content": "You are a helpful, factual, and highly specific assistant."},
-                {"role": "user",
-                 "content": f"""INSTRUCTIONS\nGiven a description of a person, return an enumerated list of the likely effects of {event_name} on this person. 
-                     Be very specific and very realistic. The effects can be related to any aspect of the person (their personality, demographics, hobbies, location etc.) but the effects must be concrete, realistic and specific. Do not exaggerate. Write 100 words.
-                    DESCRIPTION:
-                    {character_description}"""}], temperature=0.6, max_tokens=1000, top_p=1)
-            answer = json.loads(response.choices[0].json())['message']['content']
-            return answer
-        except Exception as e:
-            print(e)
-            return get_dynamic_effects(character_description, event_name, attempt_no + 1, max_attempts)
+@app.route('/persona_job/<job_id>')
+def persona_job(job_id):
+    """
+    Status of a persona job, polled by the editor: `pending`, `done` (with the predicted event) or `failed`. Once it
+    is done, the persona is copied into the session of the user who submitted it.
+    """
+    job = persona_jobs.get(job_id)
+    if job is None:
+        return jsonify(status='unknown'), 404
+    apply_persona_job(job_id, job)
+    result = job.get('result') or {}
+    return jsonify(status=job['status'], predicted_event=result.get('predicted_event'))
 
 
-def construct_character_description(form):
-    return f"I am {form.age.data} years old from {form.location.data}, working as a {form.occupation.data}. My hobbies include {form.hobbies.data}. Here is how I describe myself: '''{form.personality.data}'''"
+def start_persona_job(character_description, event_name, parts):
+    """
+    Queue the persona job computing `parts` and point the session at it. Returns False (with a flashed message) if
+    the queue is full.
+    """
+    try:
+        job_id = persona_jobs.submit(parts)
+    except PersonaJobsBusy:
+        flash('Too many simulations are being set up right now. Please try again in a minute.', 'error')
+        return False
+    session['character_description'] = character_description
+    session['event_name'] = event_name
+    session['persona_job'] = job_id
+    for key in parts:
+        session.pop(key, None)
+    return True
+
+
+def apply_persona_job(job_id, job):
+    """
+    Copy a finished job's result into the session, if it is the session's pending persona job. A failed job stays
+    pending in the session, so the editor keeps showing the failure until the user submits the form again.
+    """
+    if job['status'] == DONE and session.get('persona_job') == job_id:
+        session.update(job['result'])
+        session.pop('persona_job')
 
 
-############################################################
-# FUNCTIONS FOR PROCESSING TEXT
-############################################################
-def get_chat_completion(character_description, event, event_effects, context, incomplete_sentence, model, temperature,
-                        max_tokens, include_event, frequency_penalty=0, attempt_no=0, max_attempts=1):
-    if attempt_no > max_attempts:
-        return None
-    else:
-        try:
-            client = app_config.client
-            if include_event:
-                system_instructions = f"INSTRUCTIONS\nA character is describing a day in their life. Finish a sentence as if you were the CHARACTER affected by {event}.\n\nCHARACTER\n{character_description}\nEVENT\n{event}\nEVENT EFFECTS\n{event_effects}.\n\nCONSTRAINTS{app_config.event_constraints}"
-            else:
-                system_instructions = f"INSTRUCTIONS\nA character is describing a day in their life. Finish a sentence as if you were the CHARACTER.\n\nCHARACTER\n{character_description}\n\nCONSTRAINTS{app_config.non_event_constraints}"
-            response = completion(model=model,
-                                  messages=[{"role": "system", "content": system_instructions},
-                                            {"role": "user",
-                                             "content": f"CONTEXT:{context}\n\nINCOMPLETE SENTENCE:{incomplete_sentence}"}],
-                                  temperature=temperature, max_tokens=max_tokens)
-            print(system_instructions)
-            print(f"CONTEXT:{context}\n\nINCOMPLETE SENTENCE:{incomplete_sentence}")
-
-            answer = json.loads(response.choices[0].model_dump_json())['message']['content']
-            return answer
-        except Exception as e:
-            return get_chat_completion(context=context, incomplete_sentence=incomplete_sentence, model=model,
-                                       temperature=temperature, max_tokens=max_tokens,
-                                       frequency_penalty=frequency_penalty,
-                                       include_event=include_event, attempt_no=attempt_no + 1, max_attempts=2)
+def get_predicted_event(character_description, event_name):
+    return persona_setup.get_predicted_event(persona_client, app_config.effects_generator_model,
+                                             character_description, event_name, cache=app_config.persona_cache)
 
 
-def remove_duplicated_completion(incomplete_sentence, completion):
-    if not incomplete_sentence or not completion:
-        return completion
+def get_dynamic_effects(character_description, event_name):
+    return persona_setup.get_dynamic_effects(persona_client, app_config.effects_generator_model,
+                                             character_description, event_name, cache=app_config.persona_cache)
 
-    incomplete_sentence = incomplete_sentence.strip()
-    completion = completion.strip()
 
-    # Case 1: Direct overlap
+def create_persona_completion(**kwargs):
+    """`chat.completions.create` of the persona setup client, admitted at persona priority."""
+    with admission.admit(PERSONA, estimate_tokens(kwargs['messages'], kwargs.get('max_tokens'))):
+        return app_config.client.chat.completions.create(**kwargs)
 
-    # Case 1a (same case):
-    if completion.startswith(incomplete_sentence):
-        return completion[len(incomplete_sentence):].lstrip()
-    # Case 1b (different case):
-    elif completion.lower().startswith(incomplete_sentence.lower()):
-        return completion[len(incomplete_sentence):].lstrip()
 
-    # Case 2: Completion is a subset of incomplete
-    elif incomplete_sentence.endswith(completion):
-        return ""
+def summarize_story_admitted(previous_summary, new_text):
+    """`summarize_story` for the context window, admitted at background priority."""
+    tokens = (len(previous_summary or '') + len(new_text)) // 4 + app_config.context_summary_max_tokens
+    with admission.admit(SPECULATIVE, tokens):
+        return summarize_story(previous_summary, new_text, model=app_config.context_summary_model,
+                               max_tokens=app_config.context_summary_max_tokens)
 
-    # Case 3: Non Direct Overlap
-    else:
-        for i in range(len(completion)):
-            if incomplete_sentence.endswith(completion[:i]):
-                return completion[i:].lstrip()
 
-        # Case 4: No overlap
-        return completion
+persona_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create_persona_completion)))
 
 
-def normalize_spacing(text):
-    if text is None:
-        return None
-    text = text.replace(u'\xa0', ' ').replace('\t', ' ')
-    text = re.sub(r'\s+', ' ', text)
-    text = text.strip()
-    return text
+def construct_character_description(form):
+    return f"I am {form.age.data} years old from {form.location.data}, working as a {form.occupation.data}. My hobbies include {form.hobbies.data}. Here is how I describe myself: '''{form.personality.data}'''"
 
 
-def remove_prompt_words(text):
-    """Remove any prompt wods that LLM accidently included in answer"""
-    bad_words = ['INSTRUCTIONS', 'CONTEXT', 'INCOMPLETE SENTENCE', 'CHARACTER DESCRIPTION', 'EVENT', 'EVENT EFFECTS']
-    pattern = re.compile(r'\b(' + '|'.join(map(re.escape, bad_words)) + r')\b')
-    text = pattern.sub('', text)
-    return text
+############################################################
+# FUNCTIONS FOR PROCESSING TEXT
+############################################################
+def build_completion_messages(character_description, event, event_effects, context, incomplete_sentence,
+                              include_event):
+    if include_event:
+        system_instructions = f"INSTRUCTIONS\nA character is describing a day in their life. Finish a sentence as if you were the CHARACTER affected by {event}.\n\nCHARACTER\n{character_description}\nEVENT\n{event}\nEVENT EFFECTS\n{event_effects}.\n\nCONSTRAINTS{app_config.event_constraints}"
+    else:
+        system_instructions = f"INSTRUCTIONS\nA character is describing a day in their life. Finish a sentence as if you were the CHARACTER.\n\nCHARACTER\n{character_description}\n\nCONSTRAINTS{app_config.non_event_constraints}"
+    return [{"role": "system", "content": system_instructions},
+            {"role": "user", "content": f"CONTEXT:{context}\n\nINCOMPLETE SENTENCE:{incomplete_sentence}"}]
 
 
-def get_context_and_incomplete_sentence(text):
+def get_chat_completions(character_description, event, event_effects, context, incomplete_sentence, model,
+                         temperature, max_tokens, include_event, frequency_penalty=0, n=1, priority=INTERACTIVE,
+                         session_id=None, deadline_seconds=None):
     """
-    We feed into the model both the prior context for what was written and the current
-    sentence to complete. This function splits those things.
+    Texts of `n` choices from one LLM call, so the long system prompt is paid for once. None if the call was shed or
+    the dispatcher got no answer before the deadline (retries and hedging included).
     """
-    sentence_terminators = r"[.!?]"
-    sentences = re.split('({})'.format(sentence_terminators), text)
-    sentences = [sentences[i] + (sentences[i + 1] if i + 1 < len(sentences) else '') for i in
-                 range(0, len(sentences), 2)]
-
-    if len(sentences) == 1:
-        # Single sentence which could be complete or incomplete
-        if text.endswith(tuple(sentence_terminators)):
-            return sentences[0].strip(), ''
-        else:
-            return '', sentences[0].strip()
-    else:
-        if text.endswith(tuple(sentence_terminators)):
-            context = ' '.join(sentences)
-            incomplete_sentence = ""
-        else:
-            context = ' '.join(sentences[:-1])
-            incomplete_sentence = sentences[-1]
-
-    return context.strip(), incomplete_sentence.strip()
+    messages = build_completion_messages(character_description, event, event_effects, context, incomplete_sentence,
+                                         include_event)
+    return dispatcher.complete(model=model, messages=messages, temperature=temperature, max_tokens=max_tokens, n=n,
+                               priority=priority, sid=session_id, deadline_seconds=deadline_seconds)
 
 
-def extract_complete_words(text):
-    """
-    Extracts complete words from the given text since sometimes the LLM returns
-    incomplete words depending on tokens. But in practice, it is expensive to accurately check if a word is complete,
-    so a simple heuristic is used:
-
-    - If the immediate character before the last word is whitespace or punctuation, then the word is necessarily complete.
-    - If the word is not necessarily complete, then it is assumed to be incomplete.
-    - Note: This means in practice we often just delete the last word of the completion.
+def get_chat_completion(**completion_kwargs):
+    """The first choice of `get_chat_completions`, or None."""
+    completions = get_chat_completions(**completion_kwargs)
+    return completions[0] if completions else None
 
-    EXAMPLES
-    "I went to the store to buy some mil" -> "I went to the store to buy some"
-    "I went to the store to buy some milk" -> "I went to the store to buy some"
 
+def stream_chat_completion(character_description, event, event_effects, context, incomplete_sentence, model,
+                           temperature, max_tokens, include_event, frequency_penalty=0, n=1, other_choices=None,
+                           session_id=None):
     """
-    if not text:
-        return text
-    words = text.split()
-    if not words:
-        return text
-    if text[-1] in string.whitespace + string.punctuation:
-        return text
-    else:
-        return ' '.join(words[:-1])
+    Same request as `get_chat_completions` but yields the first choice's content chunks as the provider streams
+    them. The other choices are accumulated into the `other_choices` dict, by choice index. Yields nothing if the
+    stream is shed by admission control.
+    """
+    messages = build_completion_messages(character_description, event, event_effects, context, incomplete_sentence,
+                                         include_event)
+    try:
+        ticket = admission.admit(INTERACTIVE, estimate_tokens(messages, max_tokens, n),
+                                 time.monotonic() + dispatcher.deadline_seconds, session_id)
+    except AdmissionRejected:
+        return
+    with ticket:
+        # Streams are not hedged, but skip a model whose circuit breaker is open
+        model = dispatcher.pick_model(model)
+        if model is None:
+            return
+        try:
+            response = completion(model=model, messages=messages, temperature=temperature, max_tokens=max_tokens,
+                                  stream=True, **n_choices(model, n))
+        except Exception as e:
+            dispatcher.record(model, False)
+            LLM_ERRORS.inc('stream')
+            request_log.log({'error': repr(e), 'call': 'stream', 'model': model})
+            return
+        try:
+            for chunk in response:
+                for choice in chunk.choices:
+                    content = choice.delta.content
+                    if not content:
+                        continue
+                    if not choice.index:
+                        yield content
+                    elif other_choices is not None:
+                        other_choices[choice.index] = other_choices.get(choice.index, '') + content
+            dispatcher.record(model, True)
+        except Exception as e:
+            dispatcher.record(model, False)
+            LLM_ERRORS.inc('stream')
+            request_log.log({'error': repr(e), 'call': 'stream', 'model': model})
+        finally:
+            # Closing the provider stream drops the HTTP connection, which is how a superseded request is cancelled
+            close = getattr(getattr(response, 'completion_stream', response), 'close', None)
+            if close is not None:
+                close()
 
 
 if __name__ == '__main__':
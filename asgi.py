@@ -0,0 +1,298 @@
+"""
+ASGI entry point for production. The autocomplete routes are served by async handlers that call the LLM with
+`litellm.acompletion` over a shared, pooled `AsyncOpenAI` client, so one process can hold hundreds of in-flight
+completions. Work that can block (the document and prompt, which split and count sentences, and the shared cache
+and session stores, which are SQLite or Redis) runs on the thread pool so it never holds up the event loop. Every
+other route is served by the Flask app, mounted on a small thread pool.
+
+Run with:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import contextlib
+import inspect
+import time
+import uuid
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from openai import AsyncOpenAI
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from admission import INTERACTIVE, AdmissionRejected, estimate_tokens
+from app import (app as flask_app, app_config, inflight, prefetcher, profiler, request_log, admission, dispatcher,
+                 candidate_store, fallback, build_completion_messages, resolve_document, prepare_completion_kwargs,
+                 postprocess_completion, normalize_spacing, get_cached_completion, cache_completion,
+                 speculate_next_completion, store_candidates, fallback_completion, learn_accepted, format_sse,
+                 CompleteWordStream)
+from dispatch import n_choices
+from documents import DocumentVersionMismatch
+from llm import CallSetupExecutor, acompletion
+from metrics import LLM_ERRORS, StageTimer, instrumented
+
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=app_config.asgi_max_connections,
+                        max_keepalive_connections=app_config.asgi_max_keepalive_connections,
+                        keepalive_expiry=app_config.asgi_keepalive_expiry),
+    timeout=httpx.Timeout(app_config.asgi_upstream_timeout))
+_async_client = None
+
+
+@instrumented('autocomplete', profiler)
+async def autocomplete(request):
+    """Async version of app.autocomplete. A superseded request cancels its upstream call."""
+    timer = StageTimer('autocomplete')
+    payload = await request.json()
+    persona, sid = await load_session(request)
+    try:
+        with timer('split'):
+            text, (context, incomplete_sentence), doc_version = await run_in_threadpool(resolve_document, sid,
+                                                                                        payload)
+    except DocumentVersionMismatch as e:
+        return JSONResponse({'error': 'version_mismatch', 'doc_version': e.version}, status_code=409)
+    client_request_id = payload.get('request_id')
+    with timer('prompt'):
+        completion_kwargs, prompt_tokens = await run_in_threadpool(prepare_completion_kwargs, sid, context,
+                                                                   incomplete_sentence, persona)
+    cached = await run_in_threadpool(get_cached_completion, completion_kwargs)
+    if cached is not None:
+        inflight.supersede(sid)
+        candidate_store.put(sid, (context, incomplete_sentence), [cached])
+        await run_in_threadpool(speculate_next_completion, sid, persona, context, incomplete_sentence, cached)
+        with timer('serialize'):
+            response = JSONResponse({'completion': cached, 'request_id': client_request_id, 'stale': False,
+                                     'doc_version': doc_version, 'prompt_tokens': 0, 'candidates': 1})
+        request_log.log({'endpoint': 'autocomplete', 'text': text, 'context': context,
+                         'incomplete_sentence': incomplete_sentence, 'cached': cached, 'timings_ms': timer.ms})
+        return response
+
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(aget_chat_completions(n=app_config.candidates, session_id=sid, **completion_kwargs))
+    request_id = inflight.begin(sid, on_superseded=lambda: loop.call_soon_threadsafe(task.cancel),
+                                client_request_id=client_request_id)
+    try:
+        with timer('upstream'):
+            completions = await task
+    except asyncio.CancelledError:
+        if inflight.is_current(sid, request_id):
+            raise  # The client went away, not a newer request
+        return JSONResponse({'completion': '', 'request_id': client_request_id, 'stale': True,
+                             'doc_version': doc_version, 'prompt_tokens': prompt_tokens})
+    finally:
+        inflight.finish(sid, request_id)
+
+    with timer('postprocess'):
+        d = {'text': text, 'context': context, 'incomplete_sentence': incomplete_sentence,
+             'prompt_context': completion_kwargs['context'], 'prompt_tokens': prompt_tokens,
+             'include_event': completion_kwargs['include_event'],
+             **postprocess_completion(incomplete_sentence, normalize_spacing(completions[0] if completions else None)),
+             'candidates': store_candidates(sid, context, incomplete_sentence, completions or [])}
+    suggestion = d['candidates'][0] if d['candidates'] else ''
+    await run_in_threadpool(cache_completion, completion_kwargs, suggestion)
+    await run_in_threadpool(speculate_next_completion, sid, persona, context, incomplete_sentence, suggestion)
+    if not suggestion:
+        suggestion = d['fallback'] = fallback_completion(sid, persona, context, incomplete_sentence)
+    with timer('serialize'):
+        response = JSONResponse({'completion': suggestion, 'request_id': client_request_id, 'stale': False,
+                                 'doc_version': doc_version, 'prompt_tokens': prompt_tokens,
+                                 'candidates': len(d['candidates']) or int(bool(suggestion)),
+                                 'fallback': bool(d.get('fallback'))})
+    request_log.log({'endpoint': 'autocomplete', **d, 'timings_ms': timer.ms})
+    return response
+
+
+@instrumented('autocomplete_stream', profiler)
+async def autocomplete_stream(request):
+    """Async version of app.autocomplete_stream, with the same events."""
+    timer = StageTimer('autocomplete_stream')
+    payload = await request.json()
+    persona, sid = await load_session(request)
+    try:
+        with timer('split'):
+            text, (context, incomplete_sentence), doc_version = await run_in_threadpool(resolve_document, sid,
+                                                                                        payload)
+    except DocumentVersionMismatch as e:
+        return JSONResponse({'error': 'version_mismatch', 'doc_version': e.version}, status_code=409)
+    client_request_id = payload.get('request_id')
+    with timer('prompt'):
+        completion_kwargs, prompt_tokens = await run_in_threadpool(prepare_completion_kwargs, sid, context,
+                                                                   incomplete_sentence, persona)
+    request_id = inflight.begin(sid, client_request_id=client_request_id)
+    cached = await run_in_threadpool(get_cached_completion, completion_kwargs)
+
+    async def generate():
+        if cached is not None:
+            inflight.finish(sid, request_id)
+            candidate_store.put(sid, (context, incomplete_sentence), [cached])
+            yield format_sse('done', {'completion': cached, 'request_id': client_request_id, 'candidates': 1})
+            await run_in_threadpool(speculate_next_completion, sid, persona, context, incomplete_sentence, cached)
+            request_log.log({'endpoint': 'autocomplete_stream', 'text': text, 'context': context,
+                             'incomplete_sentence': incomplete_sentence, 'cached': cached, 'timings_ms': timer.ms})
+            return
+        if app_config.fallback_show_while_waiting:
+            provisional = fallback.suggest(persona, incomplete_sentence)
+            if provisional:
+                yield format_sse('provisional', {'completion': provisional, 'request_id': client_request_id})
+        words = CompleteWordStream(incomplete_sentence)
+        other_choices = {}
+        chunks = astream_chat_completion(n=app_config.candidates, other_choices=other_choices, session_id=sid,
+                                         **completion_kwargs)
+        try:
+            with timer('upstream'):
+                async for chunk in chunks:
+                    if not inflight.is_current(sid, request_id):
+                        yield format_sse('stale', {'request_id': client_request_id})
+                        return
+                    delta = words.push(chunk)
+                    if delta:
+                        yield format_sse('word', {'delta': delta, 'request_id': client_request_id})
+        finally:
+            await chunks.aclose()
+            inflight.finish(sid, request_id)
+        with timer('postprocess'):
+            d = {'text': text, 'context': context, 'incomplete_sentence': incomplete_sentence,
+                 'prompt_context': completion_kwargs['context'], 'prompt_tokens': prompt_tokens,
+                 'include_event': completion_kwargs['include_event'],
+                 **postprocess_completion(incomplete_sentence, normalize_spacing(words.raw))}
+            d['candidates'] = store_candidates(sid, context, incomplete_sentence,
+                                               [words.raw, *other_choices.values()], shown=d['de_duped_completion'])
+        suggestion = d['candidates'][0] if d['candidates'] else ''
+        await run_in_threadpool(cache_completion, completion_kwargs, suggestion)
+        if not suggestion:
+            suggestion = d['fallback'] = fallback_completion(sid, persona, context, incomplete_sentence)
+        with timer('serialize'):
+            done = format_sse('done', {'completion': suggestion, 'request_id': client_request_id,
+                                       'prompt_tokens': prompt_tokens,
+                                       'candidates': len(d['candidates']) or int(bool(suggestion)),
+                                       'fallback': bool(d.get('fallback'))})
+        yield done
+        await run_in_threadpool(speculate_next_completion, sid, persona, context, incomplete_sentence, suggestion)
+        request_log.log({'endpoint': 'autocomplete_stream', **d, 'timings_ms': timer.ms})
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@instrumented('autocomplete_speculative', profiler)
+async def autocomplete_speculative(request):
+    """Async version of app.autocomplete_speculative."""
+    payload = await request.json()
+    persona, sid = await load_session(request)
+    try:
+        text, (context, incomplete_sentence), doc_version = await run_in_threadpool(resolve_document, sid, payload)
+    except DocumentVersionMismatch as e:
+        return JSONResponse({'error': 'version_mismatch', 'doc_version': e.version}, status_code=409)
+    client_request_id = payload.get('request_id')
+    await run_in_threadpool(learn_accepted, persona, text, payload.get('accepted'))
+    inflight.supersede(sid)
+    completion = await run_in_threadpool(prefetcher.take, sid, (context, incomplete_sentence))
+    if completion:
+        candidate_store.put(sid, (context, incomplete_sentence), [completion])
+        await run_in_threadpool(speculate_next_completion, sid, persona, context, incomplete_sentence, completion)
+    return JSONResponse({'completion': completion or '', 'request_id': client_request_id, 'stale': False,
+                         'hit': bool(completion), 'doc_version': doc_version})
+
+
+async def load_session(request):
+    """Load the Flask session named by the cookie from the session store. Returns (session, session id)."""
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    persona = await run_in_threadpool(flask_app.session_interface.load, flask_app, cookie)
+    # /index sets the sid, so a missing one only means this request cannot supersede or be superseded
+    return persona, persona.get('sid') or uuid.uuid4().hex
+
+
+def upstream_client_kwargs(model):
+    """
+    litellm only accepts an injected client for OpenAI models; other providers, and the fake backend, use litellm's
+    own pool or none.
+    """
+    if app_config.llm_backend == 'fake' or 'claude' in model.lower():
+        return {}
+    return {'client': get_async_client()}
+
+
+def get_async_client():
+    """
+    The pooled AsyncOpenAI client, created on first use: it needs OPENAI_API_KEY, which Claude-only deployments and
+    the fake backend do not set.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(api_key=app_config.openai_key, http_client=http_client)
+    return _async_client
+
+
+async def aget_chat_completions(character_description, event, event_effects, context, incomplete_sentence, model,
+                                temperature, max_tokens, include_event, frequency_penalty=0, n=1, session_id=None):
+    messages = build_completion_messages(character_description, event, event_effects, context, incomplete_sentence,
+                                         include_event)
+    return await dispatcher.acomplete(model=model, messages=messages, temperature=temperature, max_tokens=max_tokens,
+                                      n=n, sid=session_id, client_kwargs=upstream_client_kwargs)
+
+
+async def astream_chat_completion(character_description, event, event_effects, context, incomplete_sentence, model,
+                                  temperature, max_tokens, include_event, frequency_penalty=0, n=1,
+                                  other_choices=None, session_id=None):
+    messages = build_completion_messages(character_description, event, event_effects, context, incomplete_sentence,
+                                         include_event)
+    try:
+        ticket = await admission.aadmit(INTERACTIVE, estimate_tokens(messages, max_tokens, n),
+                                        time.monotonic() + dispatcher.deadline_seconds, session_id)
+    except AdmissionRejected:
+        return
+    with ticket:
+        model = dispatcher.pick_model(model)
+        if model is None:
+            return
+        try:
+            response = await acompletion(model=model, messages=messages, temperature=temperature, max_tokens=max_tokens,
+                                         stream=True, **n_choices(model, n), **upstream_client_kwargs(model))
+        except Exception as e:
+            dispatcher.record(model, False)
+            LLM_ERRORS.inc('stream')
+            request_log.log({'error': repr(e), 'call': 'stream', 'model': model})
+            return
+        try:
+            async for chunk in response:
+                for choice in chunk.choices:
+                    content = choice.delta.content
+                    if not content:
+                        continue
+                    if not choice.index:
+                        yield content
+                    elif other_choices is not None:
+                        other_choices[choice.index] = other_choices.get(choice.index, '') + content
+            dispatcher.record(model, True)
+        except Exception as e:
+            dispatcher.record(model, False)
+            LLM_ERRORS.inc('stream')
+            request_log.log({'error': repr(e), 'call': 'stream', 'model': model})
+        finally:
+            close = getattr(getattr(response, 'completion_stream', response), 'close', None)
+            if close is not None:
+                result = close()
+                if inspect.isawaitable(result):
+                    await result
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_):
+    asyncio.get_running_loop().set_default_executor(
+        CallSetupExecutor(max_workers=app_config.asgi_setup_threads, thread_name_prefix='llm-setup'))
+    yield
+    await http_client.aclose()
+    request_log.close()
+
+
+application = Starlette(
+    routes=[
+        Route('/autocomplete', autocomplete, methods=['POST']),
+        Route('/autocomplete/stream', autocomplete_stream, methods=['POST']),
+        Route('/autocomplete/speculative', autocomplete_speculative, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=app_config.asgi_wsgi_threads)),
+    ],
+    lifespan=lifespan)
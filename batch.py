@@ -0,0 +1,212 @@
+"""
+Offline batch completions. Runs the autocomplete pipeline over a JSONL corpus, in this process, without going through
+the web app. The pipeline is the split into context and incomplete sentence, the prompt budget, the dispatcher and the
+post-processing. Use it to re-run logged sessions or a wave of essays against a new model or new config.yaml
+constraints.
+
+Each input line is one completion request, either of:
+    {"id": "p12-3", "text": "I woke up late. Then I"}
+    {"context": "I woke up late.", "incomplete_sentence": "Then I"}
+Request log records (logs/requests-<pid>.jsonl) have the second form. `id` defaults to the line number. A record may
+carry its own persona as `character_description`, `event_name` and `event_description`. Otherwise --character
+(a character in config.yaml) and the configured event are used.
+
+Input is streamed. At most --concurrency completions are in flight, and LLM calls are admitted at batch priority
+within --rpm / --tpm. Every result is appended to the output file as soon as it is ready. With --resume, records that
+already have an `ok` result there are skipped. If a record is run again, the last line for its id is the current
+result.
+
+    python batch.py essays.jsonl results.jsonl --concurrency 16 --rpm 500 --model gpt-4o-mini
+    python batch.py essays.jsonl results.jsonl --resume
+    python batch.py essays.jsonl results.jsonl --dry-run --limit 100
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def read_records(path, done, limit=None):
+    """Yield (id, record) for each JSON line of `path` whose id is not in `done`, skipping blank and invalid lines."""
+    read = 0
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping line {line_no}: not valid JSON", file=sys.stderr)
+                continue
+            record_id = str(record.get('id', line_no))
+            if record_id in done:
+                continue
+            if limit is not None and read >= limit:
+                return
+            read += 1
+            yield record_id, record
+
+
+def load_checkpoint(path):
+    """
+    Ids with an `ok` result in an earlier run's output. A line cut short by a crash is truncated away so new results
+    start on a line of their own.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+    done = set()
+    for line in data[:end].decode('utf-8').splitlines():
+        try:
+            result = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if result.get('status') == 'ok':
+            done.add(result['id'])
+    return done
+
+
+class BatchRunner:
+    def __init__(self, app_module, persona, model=None, deadline_seconds=60.0):
+        self.app = app_module
+        self.persona = persona
+        self.model = model
+        self.deadline_seconds = deadline_seconds
+
+    def run(self, record_id, record):
+        """Complete one record. Returns its result line (a dict); failures are reported in it rather than raised."""
+        from admission import BATCH
+        from text_processing import normalize_spacing, postprocess_completion
+
+        start = time.monotonic()
+        try:
+            if 'incomplete_sentence' in record:
+                context = normalize_spacing(record.get('context') or '')
+                incomplete_sentence = normalize_spacing(record['incomplete_sentence'])
+            else:
+                context, incomplete_sentence = self.app.split_text(record.get('text') or '')
+            persona = self.persona_for(record)
+            completion_kwargs, prompt_tokens = self.app.prepare_completion_kwargs(None, context, incomplete_sentence,
+                                                                                  persona)
+            if self.model:
+                completion_kwargs['model'] = self.model
+            completion = normalize_spacing(self.app.get_chat_completion(
+                priority=BATCH, deadline_seconds=self.deadline_seconds, **completion_kwargs))
+        except Exception as e:
+            return {'id': record_id, 'status': 'error', 'error': repr(e),
+                    'seconds': round(time.monotonic() - start, 3)}
+        result = postprocess_completion(incomplete_sentence, completion)
+        return {'id': record_id, 'status': 'ok' if completion else 'empty', 'context': context,
+                'incomplete_sentence': incomplete_sentence, 'model': completion_kwargs['model'],
+                'include_event': completion_kwargs['include_event'],
+                'temperature': completion_kwargs['temperature'], 'max_tokens': completion_kwargs['max_tokens'],
+                'prompt_tokens': prompt_tokens, **result, 'seconds': round(time.monotonic() - start, 3)}
+
+    def persona_for(self, record):
+        if 'character_description' not in record:
+            return self.persona
+        persona = {'character_description': record['character_description'],
+                   'event_name': record.get('event_name', self.persona['event_name'])}
+        persona['event_description'] = record.get('event_description') or self.app.get_dynamic_effects(
+            persona['character_description'], persona['event_name'])
+        return persona
+
+
+def run_batch(runner, records, output_path, concurrency, progress_every=100):
+    """Run `records` on `concurrency` threads, appending each result to `output_path`. Returns counts by status."""
+    counts = {}
+    lock = threading.Lock()
+    start = time.monotonic()
+    with open(output_path, 'a', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        def write(result):
+            with lock:
+                out.write(json.dumps(result, default=str) + '\n')
+                out.flush()
+                counts[result['status']] = counts.get(result['status'], 0) + 1
+                finished = sum(counts.values())
+            if finished % progress_every == 0:
+                elapsed = time.monotonic() - start
+                print(f"{finished} done in {elapsed:.0f}s ({finished / elapsed:.1f}/s) {counts}", file=sys.stderr)
+
+        pending = set()
+        for record_id, record in records:
+            # Keep the input streaming: only a bounded number of records is read ahead
+            if len(pending) >= concurrency * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write(future.result())
+            pending.add(executor.submit(runner.run, record_id, record))
+        for future in pending:
+            write(future.result())
+    return counts
+
+
+def default_persona(app_module, character):
+    from persona_setup import describe_character
+
+    config = app_module.app_config.config
+    if character not in config['characters']:
+        raise SystemExit(f"Unknown character {character!r}; config.yaml has {', '.join(config['characters'])}")
+    character_description = describe_character(config['characters'][character])
+    event_name = config['event']['name']
+    return {'character_description': character_description, 'event_name': event_name,
+            'event_description': app_module.get_dynamic_effects(character_description, event_name)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='JSONL file of completion requests')
+    parser.add_argument('output', help='JSONL file the results are appended to')
+    parser.add_argument('--config', help='config.yaml to use (default: config.yaml)')
+    parser.add_argument('--model', help='Model to use instead of llm.model in the config')
+    parser.add_argument('--character', default='p1', help='Character in config.yaml for records without a persona')
+    parser.add_argument('--concurrency', type=int, default=8, help='Completions in flight at once')
+    parser.add_argument('--rpm', type=float, help='Requests per minute limit (default: admission settings)')
+    parser.add_argument('--tpm', type=float, help='Tokens per minute limit (default: admission settings)')
+    parser.add_argument('--deadline', type=float, default=60.0, help='Seconds a completion may wait and run')
+    parser.add_argument('--resume', action='store_true', help='Skip records with an ok result in the output')
+    parser.add_argument('--limit', type=int, help='Only run this many records')
+    parser.add_argument('--dry-run', action='store_true', help='Answer every LLM call with the local fake model')
+    args = parser.parse_args(argv)
+
+    if not args.resume and os.path.exists(args.output) and os.path.getsize(args.output):
+        raise SystemExit(f"{args.output} already has results. Use --resume to continue it, or another output file")
+    # The app reads these when it is imported
+    if args.dry_run:
+        os.environ['LLM_BACKEND'] = 'fake'
+    if args.config:
+        os.environ['AUTOCOMPLETE_CONFIG'] = args.config
+    import app as app_module
+    from admission import TokenBucket
+
+    admission = app_module.admission
+    if args.rpm or args.tpm:
+        admission.enabled = True
+        burst_seconds = app_module.app_config.admission_burst_seconds
+        if args.rpm:
+            admission.requests = TokenBucket(args.rpm, burst_seconds)
+        if args.tpm:
+            admission.tokens = TokenBucket(args.tpm, burst_seconds)
+
+    done = load_checkpoint(args.output) if args.resume else set()
+    if done:
+        print(f"Resuming: {len(done)} records already done", file=sys.stderr)
+    runner = BatchRunner(app_module, default_persona(app_module, args.character), model=args.model,
+                         deadline_seconds=args.deadline)
+    start = time.monotonic()
+    counts = run_batch(runner, read_records(args.input, done, args.limit), args.output, args.concurrency)
+    print(f"{sum(counts.values())} records in {time.monotonic() - start:.1f}s: {counts}", file=sys.stderr)
+    print(f"LLM admission: {admission.stats()}, dispatch: {app_module.dispatcher.stats()}", file=sys.stderr)
+    return 0 if not counts.get('error') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""
+Shows that prompt size stays flat as a document grows. Builds the prompt context for documents of increasing length
+with the context window from config.yaml and a stand-in summarizer (no API calls), and prints the context tokens
+sent with and without the window.
+
+Run from the repository root:
+    python -m benchmarks.context_budget --max-sentences 2000
+"""
+
+import argparse
+import random
+import time
+
+import yaml
+
+from context_window import ContextWindow
+
+WORDS = ("I walked to the bus stop in the rain and the driver waved me on without looking at my pass while a man "
+         "in a green coat read the paper out loud to nobody and the windows fogged up").split()
+
+
+def fake_summary(previous_summary, new_text):
+    """Stand-in for the LLM summarizer: a fixed-size summary, like the real one."""
+    return ' '.join((previous_summary + ' ' + new_text).split()[-80:])
+
+
+def make_sentence(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 20))).capitalize() + '.'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-sentences', type=int, default=2000)
+    parser.add_argument('--system-tokens', type=int, default=400, help='Tokens taken by the system prompt')
+    args = parser.parse_args()
+
+    with open('config.yaml') as ymlfile:
+        config = yaml.safe_load(ymlfile)
+    settings = config['context_window']
+    window = ContextWindow(summarize=fake_summary, model=config['llm']['model'],
+                           max_prompt_tokens=settings['max_prompt_tokens'],
+                           verbatim_sentences=settings['verbatim_sentences'],
+                           summarize_every_sentences=settings['summarize_every_sentences'])
+    rng = random.Random(0)
+    sentences = []
+    print(f"{'sentences':>10} {'full context tokens':>20} {'prompt context tokens':>22} {'build ms':>9}")
+    checkpoints = {n for n in (10, 50, 100, 250, 500, 1000, 2000, 5000, 10000) if n <= args.max_sentences}
+    for n in range(1, args.max_sentences + 1):
+        sentences.append(make_sentence(rng))
+        context = ' '.join(sentences)
+        start = time.perf_counter()
+        # The app passes the sentences its document store keeps, as here
+        _, prompt_tokens = window.build('benchmark', context, args.system_tokens, sentences)
+        elapsed = time.perf_counter() - start
+        window.flush()  # In the app the summary catches up between keystrokes
+        if n in checkpoints:
+            full_tokens = window.count_tokens(context)
+            print(f"{n:>10} {full_tokens:>20} {prompt_tokens:>22} {elapsed * 1000:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Minimal OpenAI-compatible chat completions server for load tests. It serves `llm.FakeLLM`, the same stand-in as the
+app's `fake` backend: every request is answered with its canned text after its latency, with or without streaming,
+and it records how many requests it had in flight at once.
+
+Run on its own with:
+    python -m benchmarks.fake_llm --port 8001 --latency 0.5
+"""
+
+import argparse
+import json
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from llm import FakeLLM, FakeLLMError
+
+
+def make_app(latency=0.5, fake=None):
+    fake = fake if fake is not None else FakeLLM(median_latency=latency)
+
+    async def chat_completions(request):
+        body = await request.json()
+        try:
+            response = await fake.acompletion(model=body.get('model', 'fake'), messages=body.get('messages'),
+                                              max_tokens=body.get('max_tokens'), stream=body.get('stream', False),
+                                              n=body.get('n') or 1)
+        except FakeLLMError as e:
+            return JSONResponse({'error': {'message': str(e), 'type': 'server_error'}}, status_code=500)
+        if body.get('stream'):
+            return StreamingResponse(sse_chunks(response), media_type='text/event-stream')
+        return JSONResponse({
+            'id': response.id, 'object': 'chat.completion', 'created': int(time.time()), 'model': response.model,
+            'choices': [{'index': choice.index, 'finish_reason': choice.finish_reason,
+                         'message': {'role': 'assistant', 'content': choice.message.content}}
+                        for choice in response.choices],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        })
+
+    app = Starlette(routes=[Route('/v1/chat/completions', chat_completions, methods=['POST'])])
+    app.state.fake = fake
+    return app
+
+
+async def sse_chunks(stream):
+    chunk_id = f'chatcmpl-{uuid.uuid4().hex}'
+    model = None
+    try:
+        async for chunk in stream:
+            model = chunk.model
+            yield sse_chunk(chunk_id, model, [{'index': choice.index, 'finish_reason': choice.finish_reason,
+                                     'delta': {'role': choice.delta.role, 'content': choice.delta.content}}
+                                    for choice in chunk.choices])
+    except FakeLLMError:
+        return  # The connection just ends, like a provider that fails mid-stream
+    yield sse_chunk(chunk_id, model, [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+    yield 'data: [DONE]\n\n'
+
+
+def sse_chunk(chunk_id, model, choices):
+    chunk = {'id': chunk_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+             'choices': choices}
+    return f'data: {json.dumps(chunk)}\n\n'
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds before each response completes')
+    args = parser.parse_args()
+    uvicorn.run(make_app(latency=args.latency), host='127.0.0.1', port=args.port, log_level='warning')
@@ -0,0 +1,121 @@
+"""
+Load test of /autocomplete against a local fake LLM, comparing the threaded Flask view with the async handler in
+asgi.py. Both are served by uvicorn in this process; in "wsgi" mode every request goes through the Flask app on a
+fixed thread pool (like gunicorn sync/gthread workers), in "asgi" mode the autocomplete route is the async handler.
+Throughput and latencies count real completions only. Answers that are empty, stale or from the local fallback (the
+call was shed or missed its deadline) are reported as degraded.
+
+Run from the repository root:
+    python -m benchmarks.load_test --requests 1000 --concurrency 300 --latency 0.5
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import threading
+import time
+import uuid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000, help='Total autocomplete requests per mode')
+    parser.add_argument('--concurrency', type=int, default=300, help='Concurrent simulated writers')
+    parser.add_argument('--latency', type=float, default=0.5, help='Fake LLM latency in seconds')
+    parser.add_argument('--wsgi-threads', type=int, default=10, help='Thread pool size in wsgi mode')
+    parser.add_argument('--modes', nargs='+', default=['wsgi', 'asgi'], choices=['wsgi', 'asgi'])
+    args = parser.parse_args()
+
+    # Point every OpenAI client at the fake server before the app builds its clients
+    llm_port = free_port()
+    os.environ['OPENAI_API_KEY'] = os.environ.get('OPENAI_API_KEY', 'fake-key')
+    os.environ['OPENAI_BASE_URL'] = os.environ['OPENAI_API_BASE'] = f'http://127.0.0.1:{llm_port}/v1'
+
+    from a2wsgi import WSGIMiddleware
+
+    from benchmarks.fake_llm import make_app
+
+    fake_llm = make_app(latency=args.latency)
+    start_server(fake_llm, llm_port)
+
+    import app
+    import asgi
+
+    # Measure raw upstream concurrency, not cache hits or prefetches
+    app.completion_cache.enabled = False
+    app.prefetcher.enabled = False
+
+    targets = {'wsgi': WSGIMiddleware(app.app, workers=args.wsgi_threads), 'asgi': asgi.application}
+    for mode in args.modes:
+        port = free_port()
+        start_server(targets[mode], port)
+        fake_llm.state.fake.reset()
+        result = asyncio.run(run_load(f'http://127.0.0.1:{port}', app.app, args.requests, args.concurrency))
+        print(f"{mode}: {result['throughput']:.1f} req/s, p50 {result['p50']:.3f}s, p95 {result['p95']:.3f}s, "
+              f"degraded {result['degraded']}, errors {result['errors']}, "
+              f"peak upstream in flight {fake_llm.state.fake.stats()['max_in_flight']}")
+
+
+async def run_load(base_url, flask_app, n_requests, concurrency):
+    import httpx
+
+    latencies = []
+    degraded = 0
+    errors = 0
+    queue = asyncio.Queue()
+    for i in range(n_requests):
+        queue.put_nowait(i)
+
+    async def writer():
+        nonlocal degraded, errors
+        # Each simulated writer has its own session, so requests do not supersede each other. Sessions are seeded
+        # in the session store with a ready persona, skipping /user_settings and the persona job's LLM calls
+        cookie = flask_app.session_interface.create(flask_app, {
+            'sid': uuid.uuid4().hex, 'character_description': 'I am 30 years old.',
+            'event_name': 'winning the lottery', 'event_description': '1. Buys a boat.'})
+        cookie_name = flask_app.config['SESSION_COOKIE_NAME']
+        async with httpx.AsyncClient(base_url=base_url, cookies={cookie_name: cookie}, timeout=120) as client:
+            while not queue.empty():
+                queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    response = await client.post('/autocomplete', json={'text': 'I woke up early. Then I'})
+                    response.raise_for_status()
+                    body = response.json()
+                    if body['completion'] and not body.get('fallback') and not body.get('stale'):
+                        latencies.append(time.perf_counter() - start)
+                    else:
+                        degraded += 1
+                except httpx.HTTPError:
+                    errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(writer() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'throughput': len(latencies) / elapsed, 'degraded': degraded, 'errors': errors,
+            'p50': statistics.median(latencies) if latencies else float('nan'),
+            'p95': latencies[int(0.95 * (len(latencies) - 1))] if latencies else float('nan')}
+
+
+def start_server(asgi_app, port):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host='127.0.0.1', port=port, log_level='warning',
+                                           limit_concurrency=10000, backlog=4096))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Times the completion post-processing in text_processing.py against the original implementation on generated
+completions of increasing length. That both return the same results is checked by tests/test_postprocess.py.
+
+Run from the repository root:
+    python -m benchmarks.postprocess_bench --lengths 10 100 1000 10000
+"""
+
+import argparse
+import random
+import timeit
+
+from tests.test_postprocess import legacy_normalize_spacing, legacy_postprocess_completion, make_case
+from text_processing import normalize_spacing, postprocess_completion
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='Completion lengths to time, in generated words')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'words':>8} {'legacy us':>12} {'current us':>12} {'speedup':>8}")
+    for length in args.lengths:
+        cases = [make_case(rng, length) for _ in range(20)]
+        number = max(1, 20000 // length)
+        legacy = min(timeit.repeat(lambda: [legacy_postprocess_completion(i, legacy_normalize_spacing(c))
+                                            for i, c in cases], number=number, repeat=3))
+        current = min(timeit.repeat(lambda: [postprocess_completion(i, normalize_spacing(c)) for i, c in cases],
+                                    number=number, repeat=3))
+        per_call = len(cases) * number
+        print(f"{length:>8} {legacy / per_call * 1e6:>12.1f} {current / per_call * 1e6:>12.1f} "
+              f"{legacy / current:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
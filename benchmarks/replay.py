@@ -0,0 +1,329 @@
+"""
+End-to-end latency and throughput benchmark. Replays typing sessions against the app served by uvicorn in this
+process, with every LLM call answered by the fake backend in llm.py, so no API keys are needed. Each session fills
+in /user_settings, opens /index and polls /persona_job until the persona is ready, then types: after each burst of
+words it waits out the debounce and asks /autocomplete (or /autocomplete/stream) for a suggestion, sending edits
+like the editor does, and sometimes accepts it with Tab (/autocomplete/speculative).
+
+Reports p50/p95/p99 latency per endpoint, throughput, and how many upstream LLM calls were made. With --baseline,
+exits non-zero if any p95 or the throughput regressed by more than --tolerance against an earlier --output.
+
+Sessions are generated, or read from a JSONL file (--sessions) with one session per line:
+    {"persona": {...user_settings form fields, optional...},
+     "events": [{"wait": 1.2, "type": "I woke up"}, {"wait": 0.8, "text": "I woke up early. I"},
+                {"wait": 0.3, "tab": true}]}
+"type" appends to the text and "text" replaces it; both are followed by an autocomplete request, unless, as in the
+editor, the text changed by fewer than autocomplete.min_new_characters since the last suggestion, or the typed text
+is the start of the shown suggestion (counted as `kept`). "tab" accepts the last suggestion. "wait" is the seconds
+before the event, scaled by --time-scale.
+
+Run from the repository root:
+    python -m benchmarks.replay --users 50 --bursts 20 --median-latency 0.4 --output replay.json
+    python -m benchmarks.replay --users 50 --bursts 20 --median-latency 0.4 --baseline replay.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from collections import defaultdict
+
+from benchmarks.load_test import free_port, start_server
+from completion_cache import NO_SPACE_BEFORE
+
+WORDS = ("I walked to the bus stop in the rain and the driver waved me on without looking at my pass while a man "
+         "in a green coat read the paper out loud to nobody and the windows fogged up").split()
+PERSONA = {'age': 30, 'occupation': 'line cook', 'location': 'Dayton, Ohio', 'hobbies': 'fishing, bowling',
+           'personality': 'quiet, stubborn, kind', 'event': 'winning the lottery'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50, help='Concurrent generated sessions')
+    parser.add_argument('--bursts', type=int, default=20, help='Autocomplete requests per generated session')
+    parser.add_argument('--sessions', help='JSONL file of recorded sessions to replay instead of generated ones')
+    parser.add_argument('--server', default='asgi', choices=['asgi', 'wsgi'])
+    parser.add_argument('--wsgi-threads', type=int, default=10, help='Thread pool size with --server wsgi')
+    parser.add_argument('--stream', action='store_true', help='Use /autocomplete/stream')
+    parser.add_argument('--typing-cps', type=float, default=5.0, help='Typing speed of generated sessions, chars/s')
+    parser.add_argument('--accept-rate', type=float, default=0.3, help='Share of suggestions accepted with Tab')
+    parser.add_argument('--time-scale', type=float, default=0.1, help='Multiplier on every wait between events')
+    parser.add_argument('--median-latency', type=float, default=0.5, help='Fake LLM median latency, seconds')
+    parser.add_argument('--latency-sigma', type=float, default=0.3, help='Fake LLM lognormal sigma')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of fake LLM calls that fail')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression vs --baseline')
+    args = parser.parse_args()
+
+    os.environ['LLM_BACKEND'] = 'fake'
+    start = time.perf_counter()
+    import app
+    import asgi
+    startup = time.perf_counter() - start
+
+    import llm
+    from a2wsgi import WSGIMiddleware
+
+    fake = llm.FakeLLM(median_latency=args.median_latency, latency_sigma=args.latency_sigma,
+                       error_rate=args.error_rate, seed=args.seed)
+    llm.use_backend(fake)
+    app.app.config['WTF_CSRF_ENABLED'] = False
+
+    rng = random.Random(args.seed)
+    if args.sessions:
+        with open(args.sessions) as f:
+            sessions = [json.loads(line) for line in f if line.strip()]
+    else:
+        debounce = app.app_config.debounce_time / 1000
+        sessions = [generate_session(rng, args.bursts, args.typing_cps, debounce, args.accept_rate)
+                    for _ in range(args.users)]
+
+    target = asgi.application if args.server == 'asgi' else WSGIMiddleware(app.app, workers=args.wsgi_threads)
+    port = free_port()
+    start_server(target, port)
+    recorder = Recorder()
+    start = time.perf_counter()
+    asyncio.run(run_sessions(f'http://127.0.0.1:{port}', sessions, recorder, args.stream, args.time_scale,
+                             app.app_config.min_sentences, app.app_config.min_new_characters))
+    elapsed = time.perf_counter() - start
+
+    results = recorder.summary(elapsed)
+    results['startup_seconds'] = startup
+    results['upstream'] = fake.stats()
+    results['completion_cache'] = app.completion_cache.stats()
+    results['speculative'] = app.prefetcher.stats()
+    results['fallback'] = app.fallback.stats()
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+def generate_session(rng, bursts, typing_cps, debounce, accept_rate):
+    events = []
+    for _ in range(bursts):
+        words = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 5)))
+        if rng.random() < 0.25:
+            words += '.'
+        typed = ' ' + words if events else words.capitalize()
+        events.append({'wait': len(typed) / typing_cps + debounce, 'type': typed})
+        if rng.random() < accept_rate:
+            events.append({'wait': 0.5, 'tab': True})
+    return {'persona': PERSONA, 'events': events}
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.counts = defaultdict(lambda: defaultdict(int))
+
+    def add(self, endpoint, latency, outcome='ok'):
+        if outcome == 'ok':
+            self.latencies[endpoint].append(latency)
+        self.counts[endpoint][outcome] += 1
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for endpoint in sorted(self.counts):
+            latencies = sorted(self.latencies[endpoint])
+            endpoints[endpoint] = {'count': len(latencies), 'p50': percentile(latencies, 50),
+                                   'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99),
+                                   'outcomes': dict(self.counts[endpoint])}
+        completed = sum(len(self.latencies[e]) for e in ('autocomplete', 'stream', 'speculative'))
+        return {'elapsed_seconds': elapsed, 'throughput': completed / elapsed, 'endpoints': endpoints}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+async def run_sessions(base_url, sessions, recorder, stream, time_scale, min_sentences, min_new_characters):
+    import httpx
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+
+    async def run(session):
+        async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+            await replay_session(client, session, recorder, stream, time_scale, min_sentences, min_new_characters)
+
+    await asyncio.gather(*(run(session) for session in sessions))
+
+
+async def replay_session(client, session, recorder, stream, time_scale, min_sentences, min_new_characters):
+    start = time.perf_counter()
+    response = await client.post('/user_settings', data=session.get('persona', PERSONA))
+    recorder.add('user_settings', time.perf_counter() - start, outcome_of(response, expected=302))
+    start = time.perf_counter()
+    response = await client.get('/index')
+    recorder.add('index', time.perf_counter() - start, outcome_of(response))
+    # Like the editor, wait for the background persona job before typing
+    job = re.search(r'id="persona_job" value="([^"]*)"', response.text)
+    while job and job.group(1):
+        await asyncio.sleep(0.2)
+        response = await client.get(f'/persona_job/{job.group(1)}')
+        status = response.json()['status'] if response.status_code in (200, 404) else None
+        if status != 'pending':
+            outcome = outcome_of(response) if status in ('done', None) else status
+            recorder.add('persona_ready', time.perf_counter() - start, outcome)
+            break
+
+    editor = {'text': '', 'server_text': None, 'version': None, 'suggestion': '', 'shown_length': 0}
+    for event in session['events']:
+        await asyncio.sleep(event.get('wait', 0) * time_scale)
+        if event.get('tab'):
+            if not editor['suggestion']:
+                continue
+            accepted = {'accepted': editor['suggestion']}
+            editor['text'] = join_suggestion(editor['text'], editor['suggestion'])
+            editor['suggestion'] = ''
+            await request_suggestion(client, '/autocomplete/speculative', 'speculative', editor, recorder, False,
+                                     accepted)
+            continue
+        old_text = editor['text']
+        editor['text'] = event['text'] if 'text' in event else editor['text'] + event['type']
+        if type_along(editor, old_text):
+            recorder.add('kept', 0, 'kept')
+            continue
+        # Same conditions as the editor's debounced autocomplete
+        if re.search(r'[.?!:;]\s$', editor['text']) or len(re.findall(r'[.!?]', editor['text'])) < min_sentences:
+            continue
+        if abs(len(editor['text'].strip()) - editor['shown_length']) < min_new_characters:
+            continue
+        path, endpoint = ('/autocomplete/stream', 'stream') if stream else ('/autocomplete', 'autocomplete')
+        await request_suggestion(client, path, endpoint, editor, recorder, stream)
+
+
+async def request_suggestion(client, path, endpoint, editor, recorder, stream, extra=None):
+    """One suggestion request, sent as an edit against the server's copy of the text, as templates/index.html does."""
+    for attempt in range(2):
+        payload = {**document_payload(editor), **(extra or {})}
+        start = time.perf_counter()
+        if stream:
+            status, result = await read_stream(client, path, payload, recorder, start)
+        else:
+            response = await client.post(path, json=payload)
+            status, result = response.status_code, response.json() if response.status_code in (200, 409) else {}
+        if status == 409:
+            recorder.add(endpoint, time.perf_counter() - start, 'version_mismatch')
+            editor['server_text'] = editor['version'] = None
+            continue
+        if status != 200:
+            recorder.add(endpoint, time.perf_counter() - start, f'http_{status}')
+            return
+        outcome = 'stale' if result.get('stale') else 'fallback' if result.get('fallback') else 'ok'
+        recorder.add(endpoint, time.perf_counter() - start, outcome)
+        editor['suggestion'] = result.get('completion') or ''
+        if not result.get('stale'):
+            editor['shown_length'] = len(editor['text'].strip())
+        return
+
+
+async def read_stream(client, path, payload, recorder, start):
+    """Returns (status, data of the final event) and records the time to the first word."""
+    result = {}
+    first_word = True
+    async with client.stream('POST', path, json=payload) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return response.status_code, response.json() if response.status_code == 409 else {}
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith('event: '):
+                event = line[len('event: '):]
+            elif line.startswith('data: '):
+                data = json.loads(line[len('data: '):])
+                if event == 'word' and first_word:
+                    first_word = False
+                    recorder.add('stream_first_word', time.perf_counter() - start)
+                elif event == 'done':
+                    result.update(data)
+                elif event == 'stale':
+                    result['stale'] = True
+    return 200, result
+
+
+def document_payload(editor):
+    """Same payload as documentPayload() in templates/index.html, which predicts the server's next version."""
+    old, new = editor['server_text'], editor['text']
+    editor['server_text'] = new
+    if old is None:
+        editor['version'] = 1
+        return {'text': new}
+    prefix = 0
+    while prefix < min(len(old), len(new)) and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(old), len(new)) - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    delta = {'base_version': editor['version'], 'offset': prefix, 'delete': len(old) - prefix - suffix,
+             'insert': new[prefix:len(new) - suffix]}
+    editor['version'] += 1
+    return {'delta': delta}
+
+
+def type_along(editor, old_text):
+    """
+    Like the editor: if the text grew by the start of the shown suggestion, keep the rest of it. Returns whether some
+    of it is left, so that no request is needed.
+    """
+    suggestion, editor['suggestion'] = editor['suggestion'], ''
+    typed = editor['text'][len(old_text):]
+    if not suggestion or not typed or not editor['text'].startswith(old_text):
+        return False
+    pending = join_suggestion(old_text, suggestion)[len(old_text):]
+    if not pending.lower().startswith(typed.lower()):
+        return False
+    editor['suggestion'] = pending[len(typed):].lstrip()
+    return bool(editor['suggestion'])
+
+
+def join_suggestion(text, suggestion):
+    if not text or suggestion[0] in NO_SPACE_BEFORE:
+        return text + suggestion
+    return text + ' ' + suggestion
+
+
+def outcome_of(response, expected=200):
+    return 'ok' if response.status_code == expected else f'http_{response.status_code}'
+
+
+def report(results):
+    print(f"startup {results['startup_seconds']:.2f}s, {results['elapsed_seconds']:.1f}s elapsed, "
+          f"{results['throughput']:.1f} suggestions/s")
+    print(f"{'endpoint':>18} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  outcomes")
+    for endpoint, stats in results['endpoints'].items():
+        p50, p95, p99 = (f"{stats[p] * 1000:.0f}" if stats[p] is not None else '-' for p in ('p50', 'p95', 'p99'))
+        print(f"{endpoint:>18} {stats['count']:>7} {p50:>8} {p95:>8} {p99:>8}  {stats['outcomes']}")
+    print(f"upstream: {results['upstream']}")
+    print(f"completion cache: {results['completion_cache']}")
+    print(f"speculative: {results['speculative']}")
+    print(f"fallback: {results.get('fallback')}")
+
+
+def compare(baseline, results, tolerance):
+    regressions = []
+    for endpoint, stats in results['endpoints'].items():
+        before = baseline['endpoints'].get(endpoint, {}).get('p95')
+        if before and stats['p95'] and stats['p95'] > before * (1 + tolerance):
+            regressions.append(f"{endpoint} p95 {before * 1000:.0f}ms -> {stats['p95'] * 1000:.0f}ms")
+    if results['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput']:.1f}/s -> {results['throughput']:.1f}/s")
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
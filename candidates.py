@@ -0,0 +1,43 @@
+"""
+Alternative suggestions per session. Every autocomplete call asks the LLM for several candidates at once; the editor
+shows the best one and can cycle through the rest with the arrow keys, served from here without another LLM call.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class CandidateStore:
+    """The candidates for each session's latest (context, incomplete sentence), least recently used evicted first."""
+
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self.served = 0
+
+    def put(self, sid, key, candidates):
+        """Store `candidates` for `key`, with the first one as the suggestion currently shown."""
+        with self._lock:
+            self._sessions.pop(sid, None)
+            self._sessions[sid] = {'key': key, 'candidates': list(candidates), 'index': 0}
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def cycle(self, sid, key, step=1):
+        """
+        Move `step` candidates along (wrapping around) and return (candidate, position, count), or None if there is
+        nothing stored for `key`, e.g. because the text changed since the suggestion was made.
+        """
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None or entry['key'] != key or not entry['candidates']:
+                return None
+            self._sessions.move_to_end(sid)
+            entry['index'] = (entry['index'] + step) % len(entry['candidates'])
+            self.served += 1
+            return entry['candidates'][entry['index']], entry['index'], len(entry['candidates'])
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._sessions), 'served': self.served}
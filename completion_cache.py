@@ -0,0 +1,155 @@
+"""
+In-memory cache of post-processed completions, keyed on the persona, whether the event was included, the context
+and the incomplete sentence.
+
+Besides exact hits it answers prefix queries: if the user has typed the start of a suggestion we already served,
+the rest of that suggestion is returned without calling the LLM.
+
+With several worker processes, an optional `shared` store (see stores.py) is a second tier behind the in-memory one:
+every completion is also written there, and an in-memory miss is looked up there before calling the LLM.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# The editor does not insert a space before a suggestion starting with one of these
+NO_SPACE_BEFORE = '!.,;?:'
+
+
+class CompletionCache:
+    def __init__(self, max_entries=5000, ttl_seconds=900, max_prefix_candidates=8, enabled=True, shared=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_prefix_candidates = max_prefix_candidates
+        self.enabled = enabled
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (base key, incomplete sentence) -> (completion, expires at)
+        self._by_base = {}  # base key -> OrderedDict of recent incomplete sentences, for prefix lookups
+        self.hits = 0
+        self.prefix_hits = 0
+        self.shared_hits = 0
+        self.shared_errors = 0
+        self.misses = 0
+
+    @staticmethod
+    def base_key(character_description, event, include_event, context):
+        h = hashlib.sha1()
+        for part in (character_description, event, str(bool(include_event)), context):
+            h.update((part or '').encode('utf-8'))
+            h.update(b'\x1f')
+        return h.hexdigest()
+
+    def get(self, character_description, event, include_event, context, incomplete_sentence):
+        """Return a cached completion for this request, or None."""
+        if not self.enabled:
+            return None
+        base = self.base_key(character_description, event, include_event, context)
+        now = time.monotonic()
+        with self._lock:
+            completion = self._get_live((base, incomplete_sentence), now)
+            if completion is not None:
+                self.hits += 1
+                return completion
+            for old_incomplete in reversed(list(self._by_base.get(base, ()))):
+                old_completion = self._get_live((base, old_incomplete), now)
+                if old_completion is None:
+                    continue
+                remainder = typed_ahead_remainder(old_incomplete, old_completion, incomplete_sentence)
+                if remainder:
+                    self.prefix_hits += 1
+                    return remainder
+        completion = self._get_shared(base, incomplete_sentence)
+        with self._lock:
+            if completion is None:
+                self.misses += 1
+                return None
+            self.shared_hits += 1
+            self._put_local(base, incomplete_sentence, completion)
+        return completion
+
+    def put(self, character_description, event, include_event, context, incomplete_sentence, completion):
+        if not self.enabled or not completion:
+            return
+        base = self.base_key(character_description, event, include_event, context)
+        with self._lock:
+            self._put_local(base, incomplete_sentence, completion)
+        if self.shared is not None:
+            try:
+                self.shared.set(self.shared_key(base, incomplete_sentence), completion, ex=self.ttl_seconds)
+            except Exception:
+                with self._lock:
+                    self.shared_errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'prefix_hits': self.prefix_hits, 'shared_hits': self.shared_hits,
+                    'shared_errors': self.shared_errors, 'misses': self.misses, 'entries': len(self._entries)}
+
+    @staticmethod
+    def shared_key(base, incomplete_sentence):
+        return 'completion:' + hashlib.sha1(f'{base}\x1f{incomplete_sentence}'.encode('utf-8')).hexdigest()
+
+    def _get_shared(self, base, incomplete_sentence):
+        """The completion in the shared store, or None. A store that cannot be reached counts as a miss."""
+        if self.shared is None:
+            return None
+        try:
+            return self.shared.get(self.shared_key(base, incomplete_sentence))
+        except Exception:
+            with self._lock:
+                self.shared_errors += 1
+            return None
+
+    def _put_local(self, base, incomplete_sentence, completion):
+        key = (base, incomplete_sentence)
+        self._entries[key] = (completion, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(key)
+        recent = self._by_base.setdefault(base, OrderedDict())
+        recent[incomplete_sentence] = None
+        recent.move_to_end(incomplete_sentence)
+        while len(recent) > self.max_prefix_candidates:
+            old_incomplete, _ = recent.popitem(last=False)
+            self._entries.pop((base, old_incomplete), None)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def _get_live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < now:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+        base, incomplete_sentence = key
+        recent = self._by_base.get(base)
+        if recent is not None:
+            recent.pop(incomplete_sentence, None)
+            if not recent:
+                del self._by_base[base]
+
+
+def typed_ahead_remainder(old_incomplete, old_completion, incomplete_sentence):
+    """
+    If `incomplete_sentence` is `old_incomplete` plus the first whole words of `old_completion` (as the editor
+    would have joined them), return the part of `old_completion` the user has not typed yet. Otherwise None.
+    """
+    if len(incomplete_sentence) < len(old_incomplete) or not incomplete_sentence.startswith(old_incomplete):
+        return None
+    if not old_incomplete or old_completion[0] in NO_SPACE_BEFORE:
+        full = old_incomplete + old_completion
+    else:
+        full = old_incomplete + ' ' + old_completion
+    if len(full) <= len(incomplete_sentence) or not full.startswith(incomplete_sentence):
+        return None
+    next_char = full[len(incomplete_sentence)]
+    if next_char != ' ' and next_char not in NO_SPACE_BEFORE:
+        return None  # User stopped in the middle of a word
+    return full[len(incomplete_sentence):].lstrip() or None
@@ -1,11 +1,13 @@
 import yaml
 import json
-from openai import OpenAI
 import os
 import secrets
 from litellm import completion
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import llm
+from persona_setup import PersonaCache, describe_character, get_dynamic_effects, get_predicted_event
+
 class AppConfig:
     def __init__(self, config_file='config.yaml'):
         self.config = self.load_yaml_config(config_file)
@@ -25,6 +27,10 @@ class AppConfig:
         self.max_attempts = self.config['llm']['max_attempts']
         self.openai_key = os.getenv('OPENAI_API_KEY')
         self.anthropic_api_key = os.getenv('ANTHROPIC_API_KEY')
+        self.llm_backend = os.getenv('LLM_BACKEND', self.config['llm']['backend'])
+        if self.llm_backend == 'fake':
+            llm.use_backend(llm.FakeLLM(**self.config['fake_llm']))
+            print("Using the fake LLM backend")
 
         # Change settings for Anthropic
         # OPENAI temperature is in [0,2] and Anthropic is in [0,1]
@@ -34,6 +40,8 @@ class AppConfig:
             print(f"Anthropic model detected. Adjusting temperature range to {self.temperature_range}")
 
         for key in ['OPENAI_API_KEY', 'ANTHROPIC_API_KEY']:
+            if self.llm_backend == 'fake':
+                break  # The fake backend needs no keys
             # if model has 'gpt' in it ensure openai key else if 'claude' enssure anthropic
             if "gpt" in self.model.lower() and not os.getenv('OPENAI_API_KEY'):
                 raise ValueError(f"{key} environment variable not set. "
@@ -48,7 +56,9 @@ class AppConfig:
                                  f"- On Windows (PowerShell), use: $env:{key}=\"key\""
                                  f"\nReplace 'key' with your actual API key.")
 
-        self.client = OpenAI(api_key=self.openai_key)
+        self.client = llm.make_client(self.openai_key)
+        self.persona_cache = PersonaCache(path=self.config['persona_cache']['path'],
+                                          enabled=self.config['persona_cache']['enabled'])
         self.event_constraints = "\n" + "\n-".join(self.config['autocomplete']['constraints'])
         self.non_event_constraints = "\n" + "-\n".join(x for x in self.config['autocomplete']['constraints']if "{event}" not in x)
 
@@ -76,10 +86,12 @@ class AppConfig:
 
 
         elif self.experiment_enabled:
+            # Every participant describes their own character, so the event's effects are generated per participant
+            # by the persona job started from /user_settings_experiment, not here
             self.event = self.config['event']
-            self.event_description = self.get_dynamic_effects()
-            print(self.event_description)
-            
+            assert self.event and self.event.get('name'), "enable_experiment needs event.name in the config"
+            self.event_description = None
+
         else:
             #raise NotImplementedError("Dynamic character and event creation is WIP")
             pass
@@ -90,63 +102,142 @@ class AppConfig:
         self.is_offline = self.config['app_is_offline']
         self.port = int(os.environ.get('PORT', 5000))
         self.is_prod = os.environ.get('RAILWAY_ENVIRONMENT_NAME') is not None
-        self.flask_secret_key = secrets.token_hex(16)
+        self.workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+        self.flask_secret_key = os.getenv('FLASK_SECRET_KEY')
+        if not self.flask_secret_key:
+            if self.is_prod or self.workers > 1:
+                raise ValueError("FLASK_SECRET_KEY environment variable not set. Every worker and replica must sign "
+                                 "sessions with the same key. Generate one with:\n"
+                                 "python -c \"import secrets; print(secrets.token_hex(32))\"")
+            self.flask_secret_key = secrets.token_hex(16)
+            print("FLASK_SECRET_KEY not set, using a random key. Sessions will not survive a restart")
+
+        # ################################
+        # Shared state settings
+        # ################################
+        self.session_store_url = os.getenv('SESSION_STORE_URL', self.config['server']['session_store'])
+        self.session_ttl_seconds = self.config['server']['session_ttl_seconds']
+        self.shared_cache_url = os.getenv('SHARED_CACHE_URL', self.config['server']['shared_cache']) or None
 
         # ################################
         # Autocomplete behavior settings
         # ################################
         self.debounce_time = self.config['autocomplete']['debounce_time']
+        self.adaptive_debounce = self.config['autocomplete']['adaptive_debounce']
+        self.debounce_min = self.config['autocomplete']['debounce_min']
+        self.debounce_max = self.config['autocomplete']['debounce_max']
+        self.debounce_typing_factor = self.config['autocomplete']['debounce_typing_factor']
+        self.debounce_latency_factor = self.config['autocomplete']['debounce_latency_factor']
+        self.min_new_characters = self.config['autocomplete']['min_new_characters']
+        self.stream = self.config['autocomplete']['stream']
+        self.max_upstream_workers = self.config['autocomplete']['max_upstream_workers']
+        self.max_documents = self.config['autocomplete']['max_documents']
+        self.candidates = self.config['autocomplete']['candidates']
         self.min_sentences = self.config['autocomplete']['min_sentences']
         self.event_relevant = self.config['autocomplete']['event_relevant']
         self.stuck_prompts = self.config['stuck_prompts']
         assert self.min_sentences >= 1, "min_sentences must be at least 1"
+        assert self.candidates >= 1, "candidates must be at least 1"
+        assert self.debounce_min <= self.debounce_max, "debounce_min must not be above debounce_max"
         assert self.event_relevant > 0 and self.event_relevant <= 1, "min_sentences must be in (0, 1]"
 
+        # ################################
+        # Prompt size settings
+        # ################################
+        self.context_window_enabled = self.config['context_window']['enabled']
+        self.context_max_prompt_tokens = self.config['context_window']['max_prompt_tokens']
+        self.context_verbatim_sentences = self.config['context_window']['verbatim_sentences']
+        self.context_summarize_every_sentences = self.config['context_window']['summarize_every_sentences']
+        self.context_summary_model = self.config['context_window']['summary_model']
+        self.context_summary_max_tokens = self.config['context_window']['summary_max_tokens']
+
+        # ################################
+        # Completion dispatch settings
+        # ################################
+        self.dispatch_deadline_seconds = self.config['dispatch']['deadline_seconds']
+        self.dispatch_hedge_percentile = self.config['dispatch']['hedge_percentile']
+        self.dispatch_hedge_default_delay = self.config['dispatch']['hedge_default_delay']
+        self.dispatch_hedge_model = self.config['dispatch']['hedge_model'] or None
+        self.dispatch_backoff_base = self.config['dispatch']['backoff_base']
+        self.dispatch_breaker_failure_threshold = self.config['dispatch']['breaker_failure_threshold']
+        self.dispatch_breaker_reset_seconds = self.config['dispatch']['breaker_reset_seconds']
+        self.dispatch_max_workers = self.config['dispatch']['max_workers']
+
+        # ################################
+        # Persona setup job settings
+        # ################################
+        self.persona_jobs_max_workers = self.config['persona_jobs']['max_workers']
+        self.persona_jobs_max_pending = self.config['persona_jobs']['max_pending']
+        self.persona_jobs_ttl_seconds = self.config['persona_jobs']['ttl_seconds']
+        self.persona_jobs_poll_interval = self.config['persona_jobs']['poll_interval']
+
+        # ################################
+        # Admission control settings
+        # ################################
+        self.admission_enabled = self.config['admission']['enabled']
+        # The buckets live in each process, so every worker gets an equal share of the node's limits
+        self.admission_requests_per_minute = self.config['admission']['requests_per_minute'] / self.workers
+        self.admission_tokens_per_minute = self.config['admission']['tokens_per_minute'] / self.workers
+        self.admission_burst_seconds = self.config['admission']['burst_seconds']
+        self.admission_per_session = self.config['admission']['per_session']
+        self.admission_min_remaining_seconds = self.config['admission']['min_remaining_seconds']
+
+        # ################################
+        # Async serving settings
+        # ################################
+        self.asgi_max_connections = self.config['asgi']['max_connections']
+        self.asgi_max_keepalive_connections = self.config['asgi']['max_keepalive_connections']
+        self.asgi_keepalive_expiry = self.config['asgi']['keepalive_expiry']
+        self.asgi_upstream_timeout = self.config['asgi']['upstream_timeout']
+        self.asgi_setup_threads = self.config['asgi']['setup_threads']
+        self.asgi_wsgi_threads = self.config['asgi']['wsgi_threads']
+
+        # ################################
+        # Completion cache settings
+        # ################################
+        self.cache_enabled = self.config['cache']['enabled']
+        self.cache_max_entries = self.config['cache']['max_entries']
+        self.cache_ttl_seconds = self.config['cache']['ttl_seconds']
+
+        # ################################
+        # Speculative prefetch settings
+        # ################################
+        self.speculative_enabled = self.config['speculative']['enabled']
+        self.speculative_max_calls_per_session = self.config['speculative']['max_calls_per_session']
+        self.speculative_max_workers = self.config['speculative']['max_workers']
+
+        # ################################
+        # Local fallback settings
+        # ################################
+        self.fallback_enabled = self.config['fallback']['enabled']
+        self.fallback_show_while_waiting = self.config['fallback']['show_while_waiting']
+        self.fallback_max_words = self.config['fallback']['max_words']
+        self.fallback_max_personas = self.config['fallback']['max_personas']
+        self.fallback_max_vocabulary = self.config['fallback']['max_vocabulary']
+
+        # ################################
+        # Metrics and request log settings
+        # ################################
+        self.profile_sample_rate = self.config['metrics']['profile_sample_rate']
+        self.profile_dir = self.config['metrics']['profile_dir']
+        self.request_log_enabled = self.config['request_log']['enabled']
+        self.request_log_path = self.config['request_log']['path']
+        self.request_log_batch_size = self.config['request_log']['batch_size']
+        self.request_log_flush_interval = self.config['request_log']['flush_interval']
+        self.request_log_max_queue = self.config['request_log']['max_queue']
+
     def load_yaml_config(self, filepath):
         """ Load configuration from a YAML file. """
         with open(filepath, 'r') as ymlfile:
             return yaml.safe_load(ymlfile)
 
     def construct_character_description(self):
-        char_info = self.character
-        return f"I am {char_info['age']} years old from {char_info['location']}, working as a {char_info['occupation']}. My hobbies include {char_info['hobbies']}. Here is how I describe myself: '''{char_info['personality']}'''"
+        return describe_character(self.character)
 
-    def get_dynamic_effects(self, attempt_no=0, max_attempts=2):
-        if attempt_no > max_attempts:
-            return None
-        else:
-            try:
-                client = self.client
-                response = client.chat.completions.create(model=self.effects_generator_model, messages=[
-                    {"role": "system", "content": "You are a helpful, factual, and highly specific assistant."},
-                    {"role": "user",
-                     "content": f"""INSTRUCTIONS\nGiven a description of a person, return an enumerated list of the likely effects of {self.event} on this person. 
-                         Be very specific and very realistic. The effects can be related to any aspect of the person (their personality, demographics, hobbies, location etc.) but the effects must be concrete, realistic and specific. Do not exaggerate. Write 100 words.
-                        DESCRIPTION:
-                        {self.character_description}"""}], temperature=0.6, max_tokens=1000, top_p=1)
-                answer = json.loads(response.choices[0].json())['message']['content']
-                return answer
-            except Exception as e:
-                print(e)
-                return self.get_dynamic_effects(attempt_no + 1, max_attempts)
+    def get_dynamic_effects(self):
+        return get_dynamic_effects(self.client, self.effects_generator_model, self.character_description,
+                                   self.event['name'], cache=self.persona_cache)
 
     def get_predicted_event(self):
-        client = self.client
-        response = client.chat.completions.create(
-            model=self.effects_generator_model,
-            messages=[
-                {"role": "system", "content": "You are a helpful, factual, and highly specific assistant."},
-                {"role": "user", "content": (
-                    f"INSTRUCTIONS\n"
-                    f"Given a description of a person, return a realistic scenario that would cause this person to experience {self.event}. Rely ONLY on what is in the description."
-                    f"Be very specific and very realistic. Do not exaggerate. Write 20-30 words. DO NOT write about the effect of this event, but only focus on the scenario and how "
-                    f"that would make them experience {self.event}. Return one such event. Write in second person.\n"
-                    f"DESCRIPTION:\n"
-                    f"{self.character_description}"
-                )}
-            ],
-            temperature=0.6,
-            max_tokens=1000,
-            top_p=1
-        )
-        return json.loads(response.choices[0].json())['message']['content']
\ No newline at end of file
+        return get_predicted_event(self.client, self.effects_generator_model, self.character_description,
+                                   self.event['name'], cache=self.persona_cache)
@@ -0,0 +1,181 @@
+"""
+Keeps the prompt within a token budget as a story grows. The most recent sentences of the context are sent
+verbatim; older sentences are replaced by a rolling summary that is refreshed in the background, so summarizing
+never happens on the request path. Tokens are counted locally with tiktoken. Each session keeps the token counts of
+its sentences, so a request only counts the sentences that changed since the last one.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import tiktoken
+
+from llm import completion
+from metrics import LLM_ERRORS
+from text_processing import split_sentences
+
+SUMMARY_TEMPLATE = "(Summary of what I wrote earlier: {summary})"
+
+
+class ContextWindow:
+    def __init__(self, summarize, model='gpt-4o', max_prompt_tokens=2000, verbatim_sentences=8,
+                 summarize_every_sentences=4, max_workers=2, max_sessions=10000, enabled=True):
+        """`summarize(previous_summary, new_text)` returns the updated summary, or None on failure."""
+        self.summarize = summarize
+        self.max_prompt_tokens = max_prompt_tokens
+        self.verbatim_sentences = verbatim_sentences
+        self.summarize_every_sentences = summarize_every_sentences
+        self.max_sessions = max_sessions
+        self.enabled = enabled
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding('cl100k_base')  # Close enough for non-OpenAI models
+        self.count_tokens = lru_cache(maxsize=100000)(
+            lambda text: len(encoding.encode(text, disallowed_special=())))
+        self._lock = threading.Lock()
+        # sid -> {'summary': str, 'covered': int, 'pending': Future or None,
+        #         'sentences': tuple, 'counts': list of their token counts, 'tokens': their sum}
+        self._sessions = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='summarize')
+
+    def count_message_tokens(self, messages):
+        """Approximate chat prompt size: content tokens plus the per-message framing OpenAI adds."""
+        return sum(self.count_tokens(message['content']) + 4 for message in messages) + 2
+
+    def build(self, sid, context, fixed_tokens, sentences=None):
+        """
+        Fit `context` into what is left of the budget after `fixed_tokens` (system prompt, incomplete sentence).
+        `sentences` are those of `context` if the caller already has them (the session's document keeps them), so it
+        is not split again. Returns (context to put in the prompt, its token count).
+
+        A `sid` of None is a one-off build, such as a batch record: nothing is kept for it, and older sentences are
+        summarized right away, in the calling thread, so the prompt is the one a session would get once its summary
+        has caught up.
+        """
+        if not context:
+            return context, 0
+        if sentences is None:
+            sentences = split_sentences(context)
+        counts, total = self._count(sid, sentences)
+        budget = self.max_prompt_tokens - fixed_tokens
+        if not self.enabled or total <= budget:
+            return context, total
+
+        n_verbatim = 0
+        used = 0
+        while (n_verbatim < min(len(sentences), self.verbatim_sentences)
+               and used + counts[-1 - n_verbatim] <= budget):
+            used += counts[-1 - n_verbatim]
+            n_verbatim += 1
+        n_older = len(sentences) - n_verbatim
+        summary, covered = self._summary_for(sid, sentences, n_older)
+
+        parts = []
+        if summary:
+            summary_text = SUMMARY_TEMPLATE.format(summary=summary)
+            summary_tokens = self.count_tokens(summary_text) + 1
+            if used + summary_tokens <= budget:
+                parts.append(summary_text)
+                used += summary_tokens
+        # Older sentences the summary does not cover yet, most recent first, while they fit
+        uncovered = []
+        for i in range(n_older - 1, covered - 1, -1):
+            if used + counts[i] > budget:
+                break
+            uncovered.append(sentences[i])
+            used += counts[i]
+        parts.extend(reversed(uncovered))
+        parts.extend(sentences[n_older:])
+        return ' '.join(parts), used
+
+    def flush(self):
+        """Wait for pending summary refreshes. Only meant for benchmarks and scripts."""
+        with self._lock:
+            pending = [state['pending'] for state in self._sessions.values() if state['pending'] is not None]
+        for future in pending:
+            future.result()
+
+    def _count(self, sid, sentences):
+        """
+        (token counts of `sentences`, their sum). Counts are kept per session; only the sentences after the longest
+        prefix shared with the session's previous sentences are counted.
+        """
+        if sid is None:
+            counts = [self.count_tokens(sentence) + 1 for sentence in sentences]
+            return counts, sum(counts)
+        with self._lock:
+            state = self._state(sid)
+            previous, counts, total = state['sentences'], state['counts'], state['tokens']
+        shared = 0
+        for old, new in zip(previous, sentences):
+            if old is not new and old != new:
+                break
+            shared += 1
+        if shared < len(previous):
+            total -= sum(counts[shared:])
+        counts = counts[:shared]
+        for sentence in sentences[shared:]:
+            count = self.count_tokens(sentence) + 1
+            counts.append(count)
+            total += count
+        with self._lock:
+            state.update(sentences=tuple(sentences), counts=counts, tokens=total)
+        return counts, total
+
+    def _state(self, sid):
+        """The session's state, marked as most recently used. Call with the lock held."""
+        state = self._sessions.pop(sid, None) or {'summary': '', 'covered': 0, 'pending': None,
+                                                  'sentences': (), 'counts': [], 'tokens': 0}
+        self._sessions[sid] = state
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return state
+
+    def _summary_for(self, sid, sentences, n_older):
+        """Current (summary, number of leading sentences it covers). Schedules a refresh if it is falling behind."""
+        if sid is None:
+            summary = self.summarize('', ' '.join(sentences[:n_older]))
+            return (summary, n_older) if summary else ('', 0)
+        with self._lock:
+            state = self._state(sid)
+            state['covered'] = min(state['covered'], n_older)  # Earlier text was deleted
+            behind = n_older - state['covered']
+            if state['pending'] is None and behind > 0 and (
+                    not state['summary'] or behind >= self.summarize_every_sentences):
+                new_text = ' '.join(sentences[state['covered']:n_older])
+                state['pending'] = self._executor.submit(self._refresh, state, state['summary'], new_text, n_older)
+            return state['summary'], state['covered']
+
+    def _refresh(self, state, previous_summary, new_text, covered):
+        summary = None
+        try:
+            summary = self.summarize(previous_summary, new_text)
+        finally:
+            with self._lock:
+                if summary:
+                    state['summary'] = summary
+                    state['covered'] = covered
+                state['pending'] = None
+
+
+def summarize_story(previous_summary, new_text, model='gpt-4o-mini', max_tokens=150):
+    """Fold `new_text` into the running summary of the story. Returns None if the LLM call fails."""
+    try:
+        response = completion(model=model, messages=[
+            {"role": "system", "content": "You are a helpful, factual, and highly specific assistant."},
+            {"role": "user", "content": (
+                f"INSTRUCTIONS\n"
+                f"Below is a summary of the beginning of a story someone is writing about their day, followed by the "
+                f"text that comes after it. Write an updated summary of the whole story so far, in first person, in at "
+                f"most {int(max_tokens * 0.6)} words. Keep the concrete people, places, objects and events.\n"
+                f"SUMMARY:\n{previous_summary or '(none yet)'}\n"
+                f"TEXT:\n{new_text}"
+            )}], temperature=0.2, max_tokens=max_tokens)
+        return response.choices[0].message.content
+    except Exception as e:
+        LLM_ERRORS.inc('summary')
+        print(e)
+        return None
@@ -0,0 +1,304 @@
+"""
+Completion dispatcher: every suggestion has a deadline, after which it is useless. Within it, a call that has not
+answered by a high percentile of recent latencies is hedged with a duplicate (optionally to a second model), the
+first answer wins and the other call is cancelled or abandoned. Failed calls are retried with jittered exponential
+backoff, and a model that keeps failing is skipped by a circuit breaker until it has had time to recover.
+
+Each completion is admitted by the AdmissionController first (see admission.py), and is shed (returns None) if it
+cannot start in time. Hedges and retries are only sent while the rate limits have room to spare.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from admission import BATCH, INTERACTIVE, AdmissionController, AdmissionRejected, estimate_tokens
+from llm import acompletion, completion
+from metrics import LLM_ERRORS
+
+
+class CircuitBreaker:
+    """
+    Per-model breaker. After `failure_threshold` consecutive failures the model is skipped for `reset_seconds`, then
+    one trial call is let through per `reset_seconds`: success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._open_until = {}
+
+    def allow(self, model):
+        """Whether a call to `model` may be made now. Only ask right before making the call."""
+        with self._lock:
+            open_until = self._open_until.get(model)
+            if open_until is None:
+                return True
+            now = time.monotonic()
+            if now < open_until:
+                return False
+            self._open_until[model] = now + self.reset_seconds  # Hold other calls back until the trial returns
+            return True
+
+    def record(self, model, ok):
+        with self._lock:
+            if ok:
+                self._failures[model] = 0
+                self._open_until.pop(model, None)
+                return
+            self._failures[model] = self._failures.get(model, 0) + 1
+            if model in self._open_until or self._failures[model] >= self.failure_threshold:
+                self._open_until[model] = time.monotonic() + self.reset_seconds
+
+    def open_models(self):
+        with self._lock:
+            return [model for model, until in self._open_until.items() if time.monotonic() < until]
+
+
+class CompletionDispatcher:
+    def __init__(self, deadline_seconds=3.0, hedge_percentile=90, hedge_default_delay=1.0, hedge_model=None,
+                 max_retries=2, backoff_base=0.1, breaker=None, admission=None, max_workers=64, latency_window=200,
+                 min_samples=20, log=None):
+        self.deadline_seconds = deadline_seconds
+        self.hedge_percentile = hedge_percentile
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_model = hedge_model or None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.admission = admission if admission is not None else AdmissionController(enabled=False)
+        self.latency_window = latency_window
+        self.min_samples = min_samples
+        self.log = log or (lambda record: None)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dispatch')
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.retries = 0
+        self.deadline_misses = 0
+        self.failures = 0
+
+    def complete(self, model, messages, temperature, max_tokens, n=1, priority=INTERACTIVE, sid=None,
+                 deadline_seconds=None, **kwargs):
+        """
+        Blocking dispatch. Returns the texts of the `n` choices of the winning call, or None if it was shed or nothing
+        answered before the deadline. `priority` and `sid` are passed to admission control; batch calls are never
+        hedged, since they can wait. `deadline_seconds` overrides the dispatcher's deadline, e.g. for offline work that
+        can wait.
+        """
+        deadline = time.monotonic() + (deadline_seconds or self.deadline_seconds)
+        tokens = estimate_tokens(messages, max_tokens, n)
+        pending = {}
+
+        def launch(call_model, hedge=False):
+            future = self._executor.submit(self._call, call_model, messages, temperature, max_tokens, n,
+                                           deadline - time.monotonic(), kwargs)
+            pending[future] = (call_model, hedge)
+
+        try:
+            ticket = self.admission.admit(priority, tokens, deadline, sid)
+        except AdmissionRejected:
+            return None
+        with ticket:
+            return self._run(model, deadline, pending, launch, self._wait_threads,
+                             lambda: self.admission.try_admit(priority, tokens), hedge=priority != BATCH)
+
+    async def acomplete(self, model, messages, temperature, max_tokens, n=1, priority=INTERACTIVE, sid=None,
+                        deadline_seconds=None, client_kwargs=None):
+        """
+        Async version of `complete`; losing and leftover calls are cancelled. `client_kwargs(model)` returns extra
+        arguments for litellm, such as a pooled client.
+        """
+        deadline = time.monotonic() + (deadline_seconds or self.deadline_seconds)
+        tokens = estimate_tokens(messages, max_tokens, n)
+        pending = {}
+
+        def launch(call_model, hedge=False):
+            extra = client_kwargs(call_model) if client_kwargs else {}
+            task = asyncio.ensure_future(self._acall(call_model, messages, temperature, max_tokens, n,
+                                                     deadline - time.monotonic(), extra))
+            pending[task] = (call_model, hedge)
+
+        try:
+            ticket = await self.admission.aadmit(priority, tokens, deadline, sid)
+        except AdmissionRejected:
+            return None
+        try:
+            return await self._arun(model, deadline, pending, launch,
+                                    lambda: self.admission.try_admit(priority, tokens), hedge=priority != BATCH)
+        finally:
+            for task in pending:
+                task.cancel()
+            ticket.release()
+
+    def pick_model(self, model):
+        """The primary model unless its breaker is open, then the hedge model, or None if neither can be called."""
+        for candidate in (model, self.hedge_model):
+            if candidate and self.breaker.allow(candidate):
+                return candidate
+        return None
+
+    def record(self, model, ok, latency=None):
+        """Record the outcome of a call made outside the dispatcher, such as a stream."""
+        self.breaker.record(model, ok)
+        if ok and latency is not None:
+            with self._lock:
+                self._latencies.setdefault(model, deque(maxlen=self.latency_window)).append(latency)
+
+    def hedge_delay(self, model):
+        with self._lock:
+            latencies = sorted(self._latencies.get(model, ()))
+        if len(latencies) < self.min_samples:
+            return self.hedge_default_delay
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))]
+
+    def stats(self):
+        with self._lock:
+            return {'hedges': self.hedges, 'hedge_wins': self.hedge_wins, 'retries': self.retries,
+                    'failures': self.failures, 'deadline_misses': self.deadline_misses,
+                    'open_circuits': len(self.breaker.open_models())}
+
+    def _pick_hedge_model(self, first_model):
+        """The hedge model if it can be called, otherwise a duplicate of the first call."""
+        if self.hedge_model and self.hedge_model != first_model and self.breaker.allow(self.hedge_model):
+            return self.hedge_model
+        return first_model
+
+    def _run(self, model, deadline, pending, launch, wait_for, admit_extra, hedge=True):
+        first_model = self.pick_model(model)
+        if first_model is None:
+            return None
+        launch(first_model)
+        hedge_at = time.monotonic() + self.hedge_delay(first_model)
+        hedged = not hedge
+        retries = 0
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                self._count('deadline_misses')
+                return None
+            done = wait_for(pending, max(0, min(deadline, deadline if hedged else hedge_at) - now))
+            for finished in done:
+                call_model, was_hedge = pending.pop(finished)
+                choices = self._result(finished)
+                if choices is not None:
+                    if was_hedge:
+                        self._count('hedge_wins')
+                    return choices
+                if retries < self.max_retries and time.monotonic() < deadline:
+                    retries += 1
+                    self._count('retries')
+                    time.sleep(min(self._backoff(retries), max(0, deadline - time.monotonic())))
+                    retry_model = self.pick_model(model) if admit_extra() else None
+                    if retry_model is not None:
+                        launch(retry_model)
+            if not hedged and pending and time.monotonic() >= hedge_at:
+                hedged = True
+                if admit_extra():
+                    self._count('hedges')
+                    launch(self._pick_hedge_model(first_model), hedge=True)
+        return None
+
+    async def _arun(self, model, deadline, pending, launch, admit_extra, hedge=True):
+        first_model = self.pick_model(model)
+        if first_model is None:
+            return None
+        launch(first_model)
+        hedge_at = time.monotonic() + self.hedge_delay(first_model)
+        hedged = not hedge
+        retries = 0
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                self._count('deadline_misses')
+                return None
+            done, _ = await asyncio.wait(pending, timeout=max(0, min(deadline, deadline if hedged else hedge_at) - now),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                call_model, was_hedge = pending.pop(finished)
+                choices = self._result(finished)
+                if choices is not None:
+                    if was_hedge:
+                        self._count('hedge_wins')
+                    return choices
+                if retries < self.max_retries and time.monotonic() < deadline:
+                    retries += 1
+                    self._count('retries')
+                    await asyncio.sleep(min(self._backoff(retries), max(0, deadline - time.monotonic())))
+                    retry_model = self.pick_model(model) if admit_extra() else None
+                    if retry_model is not None:
+                        launch(retry_model)
+            if not hedged and pending and time.monotonic() >= hedge_at:
+                hedged = True
+                if admit_extra():
+                    self._count('hedges')
+                    launch(self._pick_hedge_model(first_model), hedge=True)
+        return None
+
+    @staticmethod
+    def _wait_threads(pending, timeout):
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        return done
+
+    def _call(self, model, messages, temperature, max_tokens, n, timeout, kwargs):
+        start = time.monotonic()
+        try:
+            response = completion(model=model, messages=messages, temperature=_temperature(model, temperature),
+                                  max_tokens=max_tokens, timeout=max(timeout, 0.001), **n_choices(model, n), **kwargs)
+        except Exception as e:
+            self._failed(model, e)
+            raise
+        self.record(model, True, time.monotonic() - start)
+        return [choice.message.content for choice in response.choices]
+
+    async def _acall(self, model, messages, temperature, max_tokens, n, timeout, kwargs):
+        start = time.monotonic()
+        try:
+            response = await acompletion(model=model, messages=messages, temperature=_temperature(model, temperature),
+                                         max_tokens=max_tokens, timeout=max(timeout, 0.001), **n_choices(model, n),
+                                         **kwargs)
+        except asyncio.CancelledError:
+            raise  # Lost the race or superseded, not a provider failure
+        except Exception as e:
+            self._failed(model, e)
+            raise
+        self.record(model, True, time.monotonic() - start)
+        return [choice.message.content for choice in response.choices]
+
+    def _failed(self, model, error):
+        self.record(model, False)
+        self._count('failures')
+        LLM_ERRORS.inc('completion')
+        self.log({'error': repr(error), 'call': 'completion', 'model': model})
+
+    @staticmethod
+    def _result(finished):
+        """Choice texts of a finished call, or None if it raised or returned no content."""
+        try:
+            choices = finished.result()
+        except Exception:
+            return None
+        return choices if choices and choices[0] is not None else None
+
+    def _backoff(self, retry_no):
+        return self.backoff_base * 2 ** (retry_no - 1) * random.uniform(0.5, 1.5)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+def _temperature(model, temperature):
+    # Anthropic temperatures are in [0, 1], OpenAI's in [0, 2] (see config.AppConfig)
+    return min(temperature, 1) if 'claude' in model.lower() else temperature
+
+
+def n_choices(model, n):
+    """The `n` argument for a call, which Anthropic models do not support; they return a single choice."""
+    return {'n': n} if n > 1 and 'claude' not in model.lower() else {}
@@ -0,0 +1,128 @@
+"""
+Server-side copy of each session's document, so the editor can send small edits instead of the whole essay on every
+keystroke. The split into context and incomplete sentence is kept up to date incrementally: an edit after the last
+sentence terminator only touches the incomplete sentence, and new sentences are appended to the cached context and to
+its list of sentences, which the prompt's context window is built from.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+from text_processing import normalize_spacing, split_sentences
+
+SENTENCE_TERMINATOR = re.compile(r'[.!?]')
+# get_context_and_incomplete_sentence treats text ending in one of these as having no incomplete sentence
+ENDS_WITHOUT_INCOMPLETE = ('[', '.', '!', '?', ']')
+
+
+class DocumentVersionMismatch(Exception):
+    def __init__(self, version):
+        super().__init__(f"Document is at version {version}")
+        self.version = version
+
+
+class Document:
+    def __init__(self, text=''):
+        self.version = 0
+        self.text = ''
+        self._cut = 0  # Index just past the last sentence terminator
+        self._sentences = ()  # Normalized sentences of text[:_cut]
+        self._context = ''  # Their join, the normalized context of text[:_cut]
+        self.reset(text)
+
+    def reset(self, text):
+        """Replace the whole document. The version restarts at 1 so the client can predict it."""
+        self.text = text
+        self.version = 1
+        self._resplit()
+
+    def apply(self, base_version, offset, delete, insert):
+        """Apply one edit made against `base_version`: remove `delete` characters at `offset`, then insert `insert`."""
+        if base_version != self.version:
+            raise DocumentVersionMismatch(self.version)
+        if offset < 0 or delete < 0 or offset + delete > len(self.text):
+            raise DocumentVersionMismatch(self.version)
+        self.text = self.text[:offset] + insert + self.text[offset + delete:]
+        self.version += 1
+        if offset < self._cut:
+            self._resplit()  # Edited an earlier sentence
+            return
+        match = None
+        for match in SENTENCE_TERMINATOR.finditer(insert):
+            pass
+        if match is not None:
+            new_cut = offset + match.end()
+            new_sentences = _normalized_sentences(self.text[self._cut:new_cut])
+            self._sentences += new_sentences
+            self._context = normalize_spacing(self._context + ' ' + ' '.join(new_sentences))
+            self._cut = new_cut
+
+    def context_and_incomplete_sentence(self):
+        """Same result as normalizing `get_context_and_incomplete_sentence` over the whole text."""
+        incomplete_sentence = normalize_spacing(self.text[self._cut:])
+        if incomplete_sentence.endswith(ENDS_WITHOUT_INCOMPLETE):
+            return normalize_spacing(self._context + ' ' + incomplete_sentence), ''
+        return self._context, incomplete_sentence
+
+    def sentences(self, context):
+        """
+        Sentences of `context`, if it starts with this document's context (it is the current one, or that plus the
+        sentences a suggestion would add). Only the rest of `context` is split. None otherwise.
+        """
+        if not context.startswith(self._context):
+            return None
+        # The context ends with a sentence terminator, and every terminator splits, so the rest splits on its own
+        return self._sentences + _normalized_sentences(context[len(self._context):])
+
+    def _resplit(self):
+        match = None
+        for match in SENTENCE_TERMINATOR.finditer(self.text):
+            pass
+        self._cut = match.end() if match else 0
+        self._sentences = _normalized_sentences(self.text[:self._cut])
+        self._context = ' '.join(self._sentences)
+
+
+class DocumentStore:
+    """Documents per session id, with least recently used sessions evicted past `max_sessions`."""
+
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._documents = OrderedDict()
+
+    def reset(self, sid, text):
+        with self._lock:
+            document = self._get_or_create(sid)
+            document.reset(text)
+            return document.text, document.context_and_incomplete_sentence(), document.version
+
+    def apply(self, sid, base_version, offset, delete, insert):
+        """
+        Returns (text, (context, incomplete sentence), version). Raises DocumentVersionMismatch, also when this
+        process has no copy of the document (evicted, or the session was served by another worker until now).
+        """
+        with self._lock:
+            if sid not in self._documents:
+                raise DocumentVersionMismatch(0)
+            document = self._get_or_create(sid)
+            document.apply(base_version, offset, delete, insert)
+            return document.text, document.context_and_incomplete_sentence(), document.version
+
+    def sentences(self, sid, context):
+        """Sentences of `context` from the session's document (see Document.sentences), or None."""
+        with self._lock:
+            document = self._documents.get(sid)
+            return document.sentences(context) if document is not None else None
+
+    def _get_or_create(self, sid):
+        document = self._documents.pop(sid, None) or Document()
+        self._documents[sid] = document
+        while len(self._documents) > self.max_sessions:
+            self._documents.popitem(last=False)
+        return document
+
+
+def _normalized_sentences(text):
+    return tuple(normalize_spacing(sentence) for sentence in split_sentences(text))
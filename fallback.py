@@ -0,0 +1,205 @@
+"""
+Local fallback suggestions. When the LLM misses its deadline, is shed or is down, the editor would get no suggestion
+at all. Instead a small word n-gram model of the persona answers, in well under a millisecond and without any network
+call. Each persona's model is trained on its own text (the character description and the event effects) and then on
+every suggestion the user accepts with Tab, so it picks up the phrasing that user actually keeps.
+
+Models are compact: words are interned once in a vocabulary shared by every model, and each context (the previous one
+or two words) maps to a flat `array` of (next word id, count) pairs.
+"""
+
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+from text_processing import split_sentences
+
+SENTENCE_END = tuple('.!?')
+# Id of the sentence start marker; the words of a sentence are predicted from it and the words before them
+START = 0
+# Context keys pack up to two word ids into one int: `id + 1` for one word, `(first + 1) * KEY_BASE + second + 1`
+# for two, so the two kinds cannot collide
+KEY_BASE = 1 << 22
+
+
+class Vocabulary:
+    """Word <-> id, shared by every persona's model. Past `max_words` new words are ignored."""
+
+    def __init__(self, max_words=200000):
+        assert max_words < KEY_BASE - 1, f"max_words must be below {KEY_BASE - 1}"
+        self.max_words = max_words
+        self._ids = {}
+        self._words = [None]  # START
+
+    def id(self, word, add=True):
+        word_id = self._ids.get(word)
+        if word_id is None and add and len(self._words) <= self.max_words:
+            word_id = len(self._words)
+            self._ids[word] = word_id
+            self._words.append(word)
+        return word_id
+
+    def word(self, word_id):
+        return self._words[word_id]
+
+    def __len__(self):
+        return len(self._words) - 1
+
+
+class NgramModel:
+    """
+    Word trigram counts with backoff to bigrams. Each context keeps at most `max_followers` next words; a new one
+    replaces the least counted one once it has been seen as often.
+    """
+
+    def __init__(self, vocabulary, max_followers=16):
+        self.vocabulary = vocabulary
+        self.max_followers = max_followers
+        self._followers = {}  # context key -> array of (word id, count) pairs
+
+    def train(self, ids, start, weight=1):
+        """Count every word of `ids` from position `start` on, after the one or two ids before it."""
+        for i in range(max(start, 1), len(ids)):
+            word_id = ids[i]
+            if word_id is None or word_id == START:
+                continue
+            for key in (_key(ids[i - 1:i]), _key(ids[i - 2:i]) if i >= 2 else None):
+                if key is not None:
+                    self._add(key, word_id, weight)
+
+    def predict(self, ids, max_words):
+        """Greedy continuation of `ids`: up to `max_words` ids, ending early at the end of a sentence."""
+        ids = list(ids)
+        predicted = []
+        seen = set()
+        while len(predicted) < max_words:
+            word_id = self._best(_key(ids[-2:])) or self._best(_key(ids[-1:]))
+            if word_id is None or (ids[-1], word_id) in seen:
+                break  # Nothing known follows, or the model started going round in a loop
+            seen.add((ids[-1], word_id))
+            predicted.append(word_id)
+            ids.append(word_id)
+            if self.vocabulary.word(word_id).endswith(SENTENCE_END):
+                break
+        return predicted
+
+    def contexts(self):
+        return len(self._followers)
+
+    def _add(self, key, word_id, weight):
+        followers = self._followers.get(key)
+        if followers is None:
+            self._followers[key] = array('I', (word_id, weight))
+            return
+        lowest = 0
+        for i in range(0, len(followers), 2):
+            if followers[i] == word_id:
+                followers[i + 1] += weight
+                return
+            if followers[i + 1] < followers[lowest + 1]:
+                lowest = i
+        if len(followers) < 2 * self.max_followers:
+            followers.extend((word_id, weight))
+        elif followers[lowest + 1] <= weight:
+            followers[lowest], followers[lowest + 1] = word_id, weight
+
+    def _best(self, key):
+        followers = self._followers.get(key) if key is not None else None
+        if not followers:
+            return None
+        best = 0
+        for i in range(2, len(followers), 2):
+            if followers[i + 1] > followers[best + 1]:
+                best = i
+        return followers[best]
+
+
+class FallbackEngine:
+    """
+    One NgramModel per persona (character and event), least recently used evicted past `max_personas`. A persona is
+    any mapping with the session's `character_description`, `event_name` and `event_description` keys; its model is
+    trained on that text the first time it is used. Accepted suggestions count `accepted_weight` times.
+    """
+
+    def __init__(self, max_personas=2000, max_vocabulary=200000, max_words=8, accepted_weight=2, enabled=True):
+        self.max_personas = max_personas
+        self.max_words = max_words
+        self.accepted_weight = accepted_weight
+        self.enabled = enabled
+        self.vocabulary = Vocabulary(max_vocabulary)
+        self._lock = threading.Lock()
+        self._models = OrderedDict()
+        self.served = 0
+        self.empty = 0
+        self.learned = 0
+
+    def suggest(self, persona, incomplete_sentence):
+        """The words most likely to follow `incomplete_sentence` for this persona, or '' if it knows none."""
+        if not self.enabled:
+            return ''
+        with self._lock:
+            model = self._model(persona)
+            ids = [START] + [self.vocabulary.id(word, add=False) for word in incomplete_sentence.split()]
+            words = [self.vocabulary.word(word_id) for word_id in model.predict(ids[-2:], self.max_words)]
+            if words:
+                self.served += 1
+            else:
+                self.empty += 1
+        return ' '.join(words)
+
+    def learn(self, persona, incomplete_sentence, accepted):
+        """Train on a suggestion the user accepted after typing `incomplete_sentence`."""
+        if not self.enabled or not accepted:
+            return
+        with self._lock:
+            model = self._model(persona)
+            lead = ([START] + [self.vocabulary.id(word) for word in incomplete_sentence.split()])[-2:]
+            model.train(lead + self._ids(accepted), start=len(lead), weight=self.accepted_weight)
+            self.learned += 1
+
+    def stats(self):
+        with self._lock:
+            return {'personas': len(self._models), 'vocabulary': len(self.vocabulary),
+                    'contexts': sum(model.contexts() for model in self._models.values()), 'served': self.served,
+                    'empty': self.empty, 'learned': self.learned}
+
+    def _model(self, persona):
+        key = _persona_key(persona)
+        model = self._models.get(key)
+        if model is not None:
+            self._models.move_to_end(key)
+            return model
+        model = NgramModel(self.vocabulary)
+        for text in (persona.get('character_description'), persona.get('event_description')):
+            for sentence in split_sentences(text or ''):
+                model.train([START] + self._ids(sentence), start=1)
+        self._models[key] = model
+        while len(self._models) > self.max_personas:
+            self._models.popitem(last=False)
+        return model
+
+    def _ids(self, text):
+        """Word ids of `text`, with a sentence start marker after every word that ends a sentence."""
+        ids = []
+        for word in text.split():
+            ids.append(self.vocabulary.id(word))
+            if word.endswith(SENTENCE_END):
+                ids.append(START)
+        return ids
+
+
+def _key(ids):
+    if not ids or None in ids:
+        return None
+    if len(ids) == 1:
+        return ids[0] + 1
+    return (ids[0] + 1) * KEY_BASE + ids[1] + 1
+
+
+def _persona_key(persona):
+    h = hashlib.sha1()
+    for part in (persona.get('character_description'), persona.get('event_name')):
+        h.update((part or '').encode('utf-8'))
+        h.update(b'\x1f')
+    return h.hexdigest()
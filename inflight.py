@@ -0,0 +1,99 @@
+"""
+Tracks in-flight autocomplete requests per session. Every request gets a server-side id that increases
+monotonically per session; when a newer request arrives, older ones for the same session are superseded so their
+upstream LLM calls can be cancelled (streaming) or abandoned (blocking) instead of holding a worker. The editor can
+also cancel its request in flight by the id it sent with it, when the text changes before the suggestion arrives.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InflightTracker:
+    def __init__(self, max_workers=32, max_sessions=10000):
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # sid -> [latest request id, callback to supersede it, client's request id]
+        self._max_sessions = max_sessions
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upstream')
+        self.started = 0
+        self.superseded = 0
+        self.cancelled = 0
+
+    def begin(self, sid, on_superseded=None, client_request_id=None):
+        """
+        Register a new request for `sid`, superseding any older one. Returns the new request id. `client_request_id`
+        is the id the editor sent with the request, for `cancel`.
+        """
+        with self._lock:
+            latest = self._sessions.pop(sid, None)
+            request_id = latest[0] + 1 if latest else 1
+            self._sessions[sid] = [request_id, on_superseded or _noop, client_request_id]
+            while len(self._sessions) > self._max_sessions:
+                self._sessions.popitem(last=False)
+            self.started += 1
+            if latest and latest[1] is not None:
+                self.superseded += 1
+        if latest and latest[1] is not None:
+            latest[1]()
+        return request_id
+
+    def is_current(self, sid, request_id):
+        with self._lock:
+            latest = self._sessions.get(sid)
+            return latest is not None and latest[0] == request_id
+
+    def finish(self, sid, request_id):
+        """Mark a request as done so a newer one does not count it as superseded."""
+        with self._lock:
+            latest = self._sessions.get(sid)
+            if latest is not None and latest[0] == request_id:
+                latest[1] = None
+
+    def supersede(self, sid):
+        """Supersede older requests for `sid` with one that is served without an upstream call."""
+        self.finish(sid, self.begin(sid))
+
+    def cancel(self, sid, client_request_id):
+        """
+        Supersede the request in flight for `sid` if it is still the one the editor sent as `client_request_id`; a
+        newer request may already have replaced it. Returns whether a request was cancelled.
+        """
+        with self._lock:
+            latest = self._sessions.get(sid)
+            if client_request_id is None or latest is None or latest[1] is None or latest[2] != client_request_id:
+                return False
+            on_superseded = latest[1]
+            self._sessions[sid] = [latest[0] + 1, None, None]
+            self.cancelled += 1
+        on_superseded()
+        return True
+
+    def run(self, sid, fn, *args, client_request_id=None, **kwargs):
+        """
+        Run `fn` on the upstream pool as the newest request for `sid`. Returns (request_id, result, stale).
+
+        The calling worker is released as soon as a newer request for the same session arrives. The upstream call
+        is cancelled if it has not started yet, otherwise it is abandoned and its result discarded.
+        """
+        wake = threading.Event()
+        request_id = self.begin(sid, on_superseded=wake.set, client_request_id=client_request_id)
+        if wake.is_set():
+            return request_id, None, True
+        future = self._executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda f: wake.set())
+        wake.wait()
+        if not self.is_current(sid, request_id):
+            future.cancel()
+            return request_id, None, True
+        self.finish(sid, request_id)
+        return request_id, future.result(), False
+
+    def stats(self):
+        with self._lock:
+            return {'started': self.started, 'superseded': self.superseded, 'cancelled': self.cancelled,
+                    'sessions': len(self._sessions)}
+
+
+def _noop():
+    pass
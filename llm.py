@@ -0,0 +1,223 @@
+"""
+Every LLM call in the app goes through `completion` / `acompletion` here (persona setup through `make_client`), so
+the provider can be swapped for `FakeLLM`: a local stand-in that needs no API keys, with configurable latency,
+streaming and error rate. Select it with `llm.backend: "fake"` in config.yaml or LLM_BACKEND=fake.
+"""
+
+import asyncio
+import inspect
+import math
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import litellm
+from openai import OpenAI
+
+FAKE_COMPLETION = "walked to the corner store and bought a loaf of bread, some eggs and a carton of milk."
+
+_backend = None  # None means the real providers, through litellm
+
+
+def use_backend(backend):
+    """Route every LLM call to `backend` (a FakeLLM), or back to the real providers with None."""
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    return _backend
+
+
+def completion(**kwargs):
+    """litellm.completion, or the fake backend's equivalent."""
+    if _backend is not None:
+        return _backend.completion(**kwargs)
+    return litellm.completion(**kwargs)
+
+
+async def acompletion(**kwargs):
+    """litellm.acompletion, or the fake backend's equivalent."""
+    if _backend is not None:
+        return await _backend.acompletion(**kwargs)
+    return await litellm.acompletion(**kwargs)
+
+
+class CallSetupExecutor(ThreadPoolExecutor):
+    """
+    Default executor for an event loop that makes litellm calls. `litellm.acompletion` builds each call's coroutine
+    on the loop's default executor. If the awaiting task is cancelled meanwhile (a hedge that lost, a missed deadline,
+    a superseded request), that coroutine is dropped unawaited. Here it is closed instead, so its request is never
+    sent.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return super().submit(fn, *args, **kwargs)
+
+        def run():
+            result = fn(*args, **kwargs)
+            if asyncio.iscoroutine(result):
+                # A second later the task that asked for it has either started it, or been cancelled and never will
+                loop.call_soon_threadsafe(loop.call_later, 1.0, _close_if_unstarted, result)
+            return result
+
+        return super().submit(run)
+
+
+def _close_if_unstarted(coroutine):
+    if inspect.getcoroutinestate(coroutine) == inspect.CORO_CREATED:
+        coroutine.close()
+
+
+def make_client(api_key):
+    """
+    OpenAI client for the persona setup calls. With the fake backend, its requests go to `completion` instead. The
+    OpenAI client is created on the first call, so a deployment without OPENAI_API_KEY can still start.
+    """
+    if _backend is not None:
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=completion)))
+    client = None
+
+    def create(**kwargs):
+        nonlocal client
+        if client is None:
+            client = OpenAI(api_key=api_key)
+        return client.chat.completions.create(**kwargs)
+
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+class FakeLLMError(Exception):
+    pass
+
+
+class FakeLLM:
+    """
+    Answers every call with the first `max_tokens` words of `text`; the `n` choices start at successive words of it,
+    so they differ. Latency is lognormal around `median_latency` seconds (a `latency_sigma` of 0 makes it fixed);
+    streamed calls spread it evenly over the words. A fraction `error_rate` of calls raise FakeLLMError once their
+    latency has passed.
+    """
+
+    def __init__(self, median_latency=0.5, latency_sigma=0.0, error_rate=0.0, text=FAKE_COMPLETION, seed=None):
+        self.median_latency = median_latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.words = text.split()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.stream_calls = 0
+            self.errors = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.calls_by_model = {}
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'stream_calls': self.stream_calls, 'errors': self.errors,
+                    'max_in_flight': self.max_in_flight, 'calls_by_model': dict(self.calls_by_model)}
+
+    def completion(self, model, messages, max_tokens=None, stream=False, n=1, **kwargs):
+        latency, fail, choices = self._start(model, max_tokens, stream, n)
+        if stream:
+            return self._stream(model, latency, fail, choices)
+        try:
+            time.sleep(latency)
+            return self._response(model, choices, fail)
+        finally:
+            self._finish()
+
+    async def acompletion(self, model, messages, max_tokens=None, stream=False, n=1, **kwargs):
+        latency, fail, choices = self._start(model, max_tokens, stream, n)
+        if stream:
+            return _AsyncStream(self._astream(model, latency, fail, choices))
+        try:
+            await asyncio.sleep(latency)
+            return self._response(model, choices, fail)
+        finally:
+            self._finish()
+
+    def _start(self, model, max_tokens, stream, n):
+        with self._lock:
+            self.calls += 1
+            self.stream_calls += bool(stream)
+            self.calls_by_model[model] = self.calls_by_model.get(model, 0) + 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            latency = self.median_latency * math.exp(self._rng.gauss(0, self.latency_sigma))
+            fail = self._rng.random() < self.error_rate
+        choices = [(self.words[i:] + self.words[:i])[:max_tokens or None] for i in range(n or 1)]
+        return latency, fail, choices
+
+    def _finish(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _fail(self):
+        with self._lock:
+            self.errors += 1
+        raise FakeLLMError("Fake LLM error")
+
+    def _response(self, model, choices, fail):
+        if fail:
+            self._fail()
+        return SimpleNamespace(id=f'chatcmpl-{uuid.uuid4().hex}', model=model, choices=[
+            SimpleNamespace(index=i, message=SimpleNamespace(role='assistant', content=' '.join(words)),
+                            finish_reason='stop')
+            for i, words in enumerate(choices)])
+
+    def _stream(self, model, latency, fail, choices):
+        try:
+            for chunks in self._chunks(model, choices):
+                time.sleep(latency / max(len(choices[0]), 1))
+                yield from chunks
+            if fail:
+                self._fail()
+        finally:
+            self._finish()
+
+    async def _astream(self, model, latency, fail, choices):
+        try:
+            for chunks in self._chunks(model, choices):
+                await asyncio.sleep(latency / max(len(choices[0]), 1))
+                for chunk in chunks:
+                    yield chunk
+            if fail:
+                self._fail()
+        finally:
+            self._finish()
+
+    @staticmethod
+    def _chunks(model, choices):
+        """For each word position, one chunk per choice, interleaved like OpenAI streams with n > 1."""
+        for position in range(max(len(words) for words in choices)):
+            chunks = []
+            for index, words in enumerate(choices):
+                if position < len(words):
+                    delta = SimpleNamespace(role='assistant',
+                                            content=words[position] if position == 0 else ' ' + words[position])
+                    chunks.append(SimpleNamespace(model=model, choices=[
+                        SimpleNamespace(index=index, delta=delta, finish_reason=None)]))
+            yield chunks
+
+
+class _AsyncStream:
+    """Async iterator over a fake stream, with the awaitable `close` that asgi.py calls on litellm streams."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.close = chunks.aclose
+
+    def __aiter__(self):
+        return self._chunks
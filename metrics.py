@@ -0,0 +1,207 @@
+"""
+Hot-path instrumentation, served at /metrics in the Prometheus text format: per-stage and per-request latency
+histograms, error counters, and the stats of the caches and pools. A sampled share of requests can also be run under
+cProfile, with each profile written to disk for `python -m pstats` or snakeviz.
+"""
+
+import cProfile
+import contextlib
+import functools
+import inspect
+import os
+import random
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [bucket counts, sum, count]
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, (list(buckets), total, count))
+                            for labels, (buckets, total, count) in self._series.items())
+        for labelvalues, (buckets, total, count) in series:
+            labels = _format_labels(self.labelnames, labelvalues)
+            for bound, bucket_count in zip(self.buckets, buckets):
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames + ("le",), labelvalues + (bound,))} '
+                             f'{bucket_count}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames + ("le",), labelvalues + ("+Inf",))} '
+                         f'{count}')
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {value}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._stats = []
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix, stats):
+        """Expose every number in the dict returned by `stats()` as the gauge `<prefix>_<key>`."""
+        self._stats.append((prefix, stats))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, stats in self._stats:
+            for key, value in stats().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'# TYPE {prefix}_{key} gauge')
+                    lines.append(f'{prefix}_{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labelnames, labelvalues):
+    if not labelnames:
+        return ''
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.histogram('autocomplete_request_seconds', 'Time to handle a request, by endpoint',
+                                     ['endpoint'])
+STAGE_SECONDS = REGISTRY.histogram('autocomplete_stage_seconds', 'Time spent in each stage of a request',
+                                   ['endpoint', 'stage'])
+LLM_ERRORS = REGISTRY.counter('autocomplete_llm_errors_total', 'LLM calls that raised, by call site', ['call'])
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram('autocomplete_admission_wait_seconds',
+                                            'Time upstream calls waited for admission, by priority', ['priority'])
+
+
+class StageTimer:
+    """
+    Times the stages of one request into STAGE_SECONDS, and keeps the timings (in ms) for the request log:
+
+        timer = StageTimer('autocomplete')
+        with timer('split'):
+            ...
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.ms = {}
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.ms[stage] = round(self.ms.get(stage, 0) + elapsed * 1000, 3)
+            STAGE_SECONDS.observe(elapsed, self.endpoint, stage)
+
+
+class Profiler:
+    """
+    Runs a random `sample_rate` share of requests under cProfile and writes each profile to
+    `directory/<endpoint>-<time>.prof`. Only one request is profiled at a time, since Python allows a single active
+    profiler; in async handlers the profile also covers whatever else the event loop ran meanwhile.
+    """
+
+    def __init__(self, sample_rate=0.0, directory='profiles'):
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self._active = threading.Lock()
+
+    @contextlib.contextmanager
+    def maybe_profile(self, endpoint):
+        if not self.sample_rate or random.random() >= self.sample_rate or not self._active.acquire(blocking=False):
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                os.makedirs(self.directory, exist_ok=True)
+                profile.dump_stats(os.path.join(self.directory, f'{endpoint}-{time.time():.6f}.prof'))
+        finally:
+            self._active.release()
+
+
+def instrumented(endpoint, profiler):
+    """Decorator recording a view's (sync or async) time in REQUEST_SECONDS, profiled when `profiler` samples it."""
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                with REQUEST_SECONDS.time(endpoint), profiler.maybe_profile(endpoint):
+                    return await view(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with REQUEST_SECONDS.time(endpoint), profiler.maybe_profile(endpoint):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
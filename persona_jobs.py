@@ -0,0 +1,94 @@
+"""
+Background persona setup. Generating a persona's event effects and predicted event takes a few gpt-4o calls. Those
+calls run here on a bounded pool instead of in the request that submitted the form. The form returns a job id at
+once, and the editor polls the job until the persona is ready.
+
+Job records live in the shared store (see stores.py), so the poll can be answered by any worker, not only the one
+running the job.
+"""
+
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class PersonaJobsBusy(Exception):
+    """Too many persona jobs are waiting; the user should try again shortly."""
+
+
+class PersonaJobQueue:
+    """
+    A job is a dict of named parts, each a callable run on the pool (so the parts of one job run in parallel).
+    Once every part has returned, the job is done and its result maps each name to its part's return value; if a
+    part raises, the job failed. Records are kept for `ttl_seconds`.
+    """
+
+    key_prefix = 'persona_job:'
+
+    def __init__(self, store, max_workers=4, max_pending=200, ttl_seconds=3600):
+        self.store = store
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='persona')
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def submit(self, parts):
+        """Queue a job and return its id. Raises PersonaJobsBusy if `max_pending` jobs are already waiting."""
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PersonaJobsBusy()
+            self.pending += 1
+            self.submitted += 1
+        job_id = uuid.uuid4().hex
+        job = {'id': job_id, 'results': {}, 'remaining': len(parts), 'error': None, 'started': time.time()}
+        self._save(job_id, {'status': PENDING})
+        for name, fn in parts.items():
+            self._executor.submit(self._run_part, job, name, fn)
+        return job_id
+
+    def get(self, job_id):
+        """The job's record: {'status': ..., 'result': {...} once done, 'error': ... if failed}, or None if unknown."""
+        record = self.store.get(self.key_prefix + job_id)
+        return json.loads(record) if record is not None else None
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self.pending, 'submitted': self.submitted, 'done': self.done, 'failed': self.failed,
+                    'rejected': self.rejected}
+
+    def _run_part(self, job, name, fn):
+        try:
+            value, error = fn(), None
+        except Exception as e:
+            value, error = None, repr(e)
+        with self._lock:
+            job['results'][name] = value
+            job['error'] = job['error'] or error
+            job['remaining'] -= 1
+            if job['remaining']:
+                return
+            self.pending -= 1
+            if job['error']:
+                self.failed += 1
+            else:
+                self.done += 1
+        if job['error']:
+            self._save(job['id'], {'status': FAILED, 'error': job['error']})
+        else:
+            self._save(job['id'], {'status': DONE, 'result': job['results'],
+                                   'seconds': round(time.time() - job['started'], 3)})
+
+    def _save(self, job_id, record):
+        self.store.set(self.key_prefix + job_id, json.dumps(record), ex=self.ttl_seconds)
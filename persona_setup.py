@@ -0,0 +1,175 @@
+"""
+Persona setup calls: the dynamic effects of the event on a character and the scenario that caused it. Shared by
+app.py and config.AppConfig and memoized in SQLite, so the same persona never costs two gpt-4o calls, across requests
+and process restarts.
+
+Pre-warm the cache for every character in config.yaml with:
+    python persona_setup.py --warm
+"""
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import LLM_ERRORS
+
+# Bump whenever the prompts below change, so cached answers to the old prompts are not reused
+PROMPT_VERSION = 1
+
+
+class PersonaCache:
+    """
+    Content-addressed SQLite store keyed on (kind, model, prompt version, character description, event name).
+    Descriptions and event names are compared case- and whitespace-insensitively.
+    """
+
+    def __init__(self, path='persona_cache.sqlite3', enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._conn = None
+        if enabled:
+            self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS persona_cache (key TEXT PRIMARY KEY, kind TEXT, model TEXT, '
+                               'prompt_version INTEGER, character_description TEXT, event_name TEXT, value TEXT, '
+                               'created_at REAL)')
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(kind, model, character_description, event_name):
+        parts = [kind, model, PROMPT_VERSION, _canonical(character_description), _canonical(event_name)]
+        return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def get(self, kind, model, character_description, event_name):
+        if not self.enabled:
+            return None
+        key = self.make_key(kind, model, character_description, event_name)
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM persona_cache WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, kind, model, character_description, event_name, value):
+        if not self.enabled or value is None:
+            return
+        key = self.make_key(kind, model, character_description, event_name)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO persona_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (key, kind, model, PROMPT_VERSION, character_description, event_name, value,
+                                time.time()))
+            self._conn.commit()
+
+    def get_or_compute(self, kind, model, character_description, event_name, compute):
+        """Return the cached value, or call `compute()` once (even under concurrent identical requests) and cache it."""
+        if not self.enabled:
+            return compute()
+        key = self.make_key(kind, model, character_description, event_name)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            value = self.get(kind, model, character_description, event_name)
+            with self._lock:
+                if value is not None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if value is None:
+                value = compute()
+                self.put(kind, model, character_description, event_name, value)
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def _canonical(text):
+    return ' '.join(str(text).lower().split())
+
+
+def get_dynamic_effects(client, model, character_description, event_name, cache=None, max_attempts=2):
+    def compute():
+        for attempt_no in range(max_attempts + 1):
+            try:
+                response = client.chat.completions.create(model=model, messages=[
+                    {"role": "system", "content": "You are a helpful, factual, and highly specific assistant."},
+                    {"role": "user",
+                     "content": f"""INSTRUCTIONS\nGiven a description of a person, return an enumerated list of the likely effects of {event_name} on this person.
+                         Be very specific and very realistic. The effects can be related to any aspect of the person (their personality, demographics, hobbies, location etc.) but the effects must be concrete, realistic and specific. Do not exaggerate. Write 100 words.
+                        DESCRIPTION:
+                        {character_description}"""}], temperature=0.6, max_tokens=1000, top_p=1)
+                return response.choices[0].message.content
+            except Exception as e:
+                LLM_ERRORS.inc('persona')
+                print(e)
+        return None
+
+    if cache is None:
+        return compute()
+    return cache.get_or_compute('dynamic_effects', model, character_description, event_name, compute)
+
+
+def get_predicted_event(client, model, character_description, event_name, cache=None):
+    def compute():
+        response = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": "You are a helpful, factual, and highly specific assistant."},
+                {"role": "user", "content": (
+                    f"INSTRUCTIONS\n"
+                    f"Given a description of a person, return a realistic scenario that would cause this person to experience {event_name}. Rely ONLY on what is in the description."
+                    f"Be very specific and very realistic. Do not exaggerate. Write 20-30 words. DO NOT write about the effect of this event, but only focus on the scenario and how "
+                    f"that would make them experience {event_name}. Return one such event. Write in second person.\n"
+                    f"DESCRIPTION:\n"
+                    f"{character_description}"
+                )}
+            ],
+            temperature=0.6,
+            max_tokens=1000,
+            top_p=1
+        )
+        return response.choices[0].message.content
+
+    if cache is None:
+        return compute()
+    return cache.get_or_compute('predicted_event', model, character_description, event_name, compute)
+
+
+def describe_character(char_info):
+    """Character description for a character from config.yaml."""
+    return f"I am {char_info['age']} years old from {char_info['location']}, working as a {char_info['occupation']}. My hobbies include {char_info['hobbies']}. Here is how I describe myself: '''{char_info['personality']}'''"
+
+
+def warm(app_config):
+    """Fill the cache for every character in config.yaml with the configured event."""
+    event_name = app_config.config['event']['name']
+    jobs = []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for char_info in app_config.config['characters'].values():
+            character_description = describe_character(char_info)
+            jobs.append(executor.submit(get_dynamic_effects, app_config.client, app_config.effects_generator_model,
+                                        character_description, event_name, app_config.persona_cache))
+            jobs.append(executor.submit(get_predicted_event, app_config.client, app_config.effects_generator_model,
+                                        character_description, event_name, app_config.persona_cache))
+        for job in jobs:
+            job.result()
+    print(app_config.persona_cache.stats())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--warm', action='store_true', help='Pre-warm the cache for the characters in config.yaml')
+    args = parser.parse_args()
+    if args.warm:
+        from config import AppConfig
+
+        warm(AppConfig())
@@ -0,0 +1,74 @@
+"""
+Structured request log. Records are appended as JSON lines by a background thread in batches, so a request only pays
+for a queue put, never for serialization or file I/O.
+"""
+
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+_STOP = object()
+
+
+class RequestLogger:
+    """
+    Background JSON-lines writer. A full queue drops the record (counted in `dropped`) instead of blocking the request.
+    `{pid}` in `path` is replaced by the process id, so worker processes do not interleave their writes.
+    """
+
+    def __init__(self, path='logs/requests.jsonl', batch_size=100, flush_interval=1.0, max_queue=10000, enabled=True):
+        self.path = path.replace('{pid}', str(os.getpid()))
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.logged = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        if enabled:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name='request-log', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def log(self, record):
+        """Queue `record` (a JSON-serializable dict, not modified afterwards) with a timestamp."""
+        if not self.enabled:
+            return
+        try:
+            self._queue.put_nowait({'ts': time.time(), **record})
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Write everything queued so far and stop the writer thread."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def stats(self):
+        return {'logged': self.logged, 'dropped': self.dropped, 'queued': self._queue.qsize()}
+
+    def _run(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                batch = [self._queue.get()]
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                    try:
+                        batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                    except queue.Empty:
+                        break
+                stop = batch[-1] is _STOP
+                records = batch[:-1] if stop else batch
+                f.writelines(json.dumps(record, default=str) + '\n' for record in records)
+                f.flush()
+                self.logged += len(records)
+                if stop:
+                    return
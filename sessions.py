@@ -0,0 +1,84 @@
+"""
+Server-side Flask sessions. The cookie only carries a signed random id, and the session itself (the persona and the
+per-session id) is kept as JSON in a shared store (see stores.py), so any worker or node can serve any request and
+the persona is no longer sent with every keystroke.
+"""
+
+import json
+import secrets
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Keeps each session in `store` under `session:<id>` for `ttl_seconds` after its last change. The id is signed with
+    the app's secret key, so every worker must be configured with the same one.
+    """
+
+    key_prefix = 'session:'
+    salt = 'server-side-session'
+
+    def __init__(self, store, ttl_seconds=30 * 24 * 3600):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+
+    def open_session(self, app, request):
+        return self.load(app, request.cookies.get(self.get_cookie_name(app)))
+
+    def load(self, app, cookie):
+        """The session for a cookie value; a new, empty one if the cookie is missing, forged or expired."""
+        sid = self._unsign(app, cookie)
+        if sid:
+            data = self.store.get(self.key_prefix + sid)
+            if data is not None:
+                return ServerSideSession(json.loads(data), sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(24), new=True)
+
+    def create(self, app, data):
+        """Store a new session holding `data` and return its cookie value, e.g. to seed sessions for a load test."""
+        sid = secrets.token_urlsafe(24)
+        self.store.set(self.key_prefix + sid, json.dumps(data), ex=self.ttl_seconds)
+        return self._signer(app).sign(sid).decode('utf-8')
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                self.store.delete(self.key_prefix + session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        self.store.set(self.key_prefix + session.sid, json.dumps(dict(session)), ex=self.ttl_seconds)
+        if session.new:
+            response.set_cookie(name, self._signer(app).sign(session.sid).decode('utf-8'),
+                                expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt, key_derivation='hmac')
+
+    def _unsign(self, app, cookie):
+        if not cookie:
+            return None
+        try:
+            return self._signer(app).unsign(cookie).decode('utf-8')
+        except BadSignature:
+            return None
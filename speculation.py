@@ -0,0 +1,73 @@
+"""
+Speculative prefetch of the next suggestion. After a suggestion is served we assume the user will accept it with
+Tab, and start generating the completion for the accepted text right away. When the accept comes in, the editor
+asks for that result instead of waiting for its debounce and a fresh LLM round trip.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+
+class SpeculativePrefetcher:
+    def __init__(self, max_calls_per_session=50, max_workers=8, max_sessions=10000, enabled=True):
+        self.max_calls_per_session = max_calls_per_session
+        self.max_sessions = max_sessions
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # sid -> {'issued': int, 'pending': (expected text, future) or None}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='speculative')
+        self.issued = 0
+        self.used = 0
+        self.wasted = 0
+        self.over_budget = 0
+
+    def schedule(self, sid, expected_text, fn, *args, **kwargs):
+        """
+        Start `fn` in the background as the speculative completion for `expected_text`. Replaces (and counts as
+        wasted) any earlier speculation for the session. Returns False if speculation is off or over budget.
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            state = self._sessions.pop(sid, None) or {'issued': 0, 'pending': None}
+            self._sessions[sid] = state
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            if state['issued'] >= self.max_calls_per_session:
+                self.over_budget += 1
+                return False
+            if state['pending'] is not None:
+                self.wasted += 1
+                state['pending'][1].cancel()
+            state['issued'] += 1
+            self.issued += 1
+            state['pending'] = (expected_text, self._executor.submit(fn, *args, **kwargs))
+        return True
+
+    def take(self, sid, text, timeout=5):
+        """Return the speculative completion for `text` if one was prepared, waiting for it if still running."""
+        with self._lock:
+            state = self._sessions.get(sid)
+            pending = state['pending'] if state else None
+            if pending is None:
+                return None
+            state['pending'] = None
+            if pending[0] != text:
+                self.wasted += 1
+                pending[1].cancel()
+                return None
+        try:
+            completion = pending[1].result(timeout=timeout)
+        except TimeoutError:
+            completion = None
+        with self._lock:
+            if completion:
+                self.used += 1
+            else:
+                self.wasted += 1
+        return completion
+
+    def stats(self):
+        with self._lock:
+            return {'issued': self.issued, 'used': self.used, 'wasted': self.wasted, 'over_budget': self.over_budget}
@@ -0,0 +1,72 @@
+"""
+Key-value stores for the state that every worker process (and every node) has to see: sessions and the shared
+completion cache. A store is opened from a URL:
+
+- `sqlite:///path/to/file.sqlite3` - a SQLite file, shared by the workers on one machine
+- `redis://host:port/db` (or `rediss://`, `unix://`) - Redis or anything speaking its protocol, shared by every node.
+  Needs the `redis` package
+
+Both have the same small interface, the subset of the Redis client the app uses: `get(key)`, `set(key, value, ex=None)`
+and `delete(key)`, with string values and `ex` a time to live in seconds.
+"""
+
+import sqlite3
+import threading
+import time
+
+
+class SQLiteStore:
+    """
+    String store in a SQLite file. Expired keys read as missing and are deleted when read; the rest are deleted in
+    bulk every `purge_every` writes.
+    """
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT value, expires_at FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            with self._lock:
+                self._conn.execute('DELETE FROM kv WHERE key = ? AND expires_at < ?', (key, time.time()))
+                self._conn.commit()
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        expires_at = time.time() + ex if ex else None
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO kv VALUES (?, ?, ?)', (key, value, expires_at))
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                self._conn.execute('DELETE FROM kv WHERE expires_at < ?', (time.time(),))
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+            self._conn.commit()
+
+
+def open_store(url):
+    if url.startswith('sqlite:///'):
+        return SQLiteStore(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        try:
+            import redis
+        except ImportError:
+            raise ValueError(f"{url} needs the redis package. Install it with: pip install redis") from None
+        return redis.Redis.from_url(url, decode_responses=True)
+    raise ValueError(f"Unsupported store URL {url!r}. Use sqlite:///path or redis://host:port/db")
@@ -0,0 +1,70 @@
+"""
+Session slots in AdmissionController. Run from the repository root with `python -m pytest tests`.
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from admission import INTERACTIVE, AdmissionController, AdmissionRejected
+
+
+def deadline(seconds=2.0):
+    return time.monotonic() + seconds
+
+
+def test_newer_call_waits_for_the_running_one_of_its_session():
+    admission = AdmissionController(per_session=1, min_remaining_seconds=0)
+    abandoned = admission.admit(INTERACTIVE, deadline=deadline(), sid='s')
+    admitted = threading.Event()
+
+    def newer():
+        with admission.admit(INTERACTIVE, deadline=deadline(), sid='s'):
+            admitted.set()
+
+    thread = threading.Thread(target=newer)
+    thread.start()
+    assert not admitted.wait(0.2)  # Still parked: the abandoned call is running at the provider
+    abandoned.release()
+    assert admitted.wait(1)
+    thread.join()
+    assert admission._in_flight == {}
+
+
+def test_newer_call_drops_the_waiting_one():
+    admission = AdmissionController(per_session=1, min_remaining_seconds=0)
+    running = admission.admit(INTERACTIVE, deadline=deadline(), sid='s')
+    errors = []
+
+    def waiting():
+        try:
+            admission.admit(INTERACTIVE, deadline=deadline(), sid='s')
+        except AdmissionRejected as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=waiting)
+    thread.start()
+    time.sleep(0.1)
+    admission.cancel('s')
+    thread.join(1)
+    assert len(errors) == 1
+    assert admission._in_flight == {'s': 1}  # The running call keeps its slot
+    running.release()
+    assert admission._in_flight == {}
+
+
+def test_cancelled_async_call_gives_up_its_place():
+    async def scenario():
+        admission = AdmissionController(per_session=1, min_remaining_seconds=0)
+        running = await admission.aadmit(INTERACTIVE, deadline=deadline(), sid='s')
+        parked = asyncio.ensure_future(admission.aadmit(INTERACTIVE, deadline=deadline(), sid='s'))
+        await asyncio.sleep(0.05)
+        parked.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await parked
+        running.release()
+        assert admission._in_flight == {} and admission._waiting == {}
+
+    asyncio.run(scenario())
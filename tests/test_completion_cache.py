@@ -0,0 +1,65 @@
+"""
+CompletionCache lookups and eviction. Run from the repository root with `python -m pytest tests`.
+"""
+
+from types import SimpleNamespace
+
+import completion_cache
+from completion_cache import CompletionCache
+
+PERSONA = ('I am 30 years old.', 'winning the lottery', True, 'I woke up early.')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def make_cache(monkeypatch, **kwargs):
+    clock = Clock()
+    monkeypatch.setattr(completion_cache, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    return CompletionCache(**kwargs), clock
+
+
+def test_exact_hit(monkeypatch):
+    cache, _ = make_cache(monkeypatch)
+    cache.put(*PERSONA, 'Then I', 'walked to the store.')
+    assert cache.get(*PERSONA, 'Then I') == 'walked to the store.'
+    assert cache.get('Someone else.', *PERSONA[1:], 'Then I') is None
+    assert cache.stats()['hits'] == 1
+
+
+def test_prefix_hit_returns_only_what_is_left_to_type(monkeypatch):
+    cache, _ = make_cache(monkeypatch)
+    cache.put(*PERSONA, 'Then I', 'walked to the store.')
+    assert cache.get(*PERSONA, 'Then I walked') == 'to the store.'
+    assert cache.get(*PERSONA, 'Then I walked to the') == 'store.'
+    assert cache.get(*PERSONA, 'Then I wal') is None  # Only whole words of the suggestion count
+    assert cache.get(*PERSONA, 'Then I ran') is None
+    assert cache.get(*PERSONA, 'Then I walked to the store.') is None  # Nothing left to suggest
+    assert cache.stats()['prefix_hits'] == 2
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    cache, clock = make_cache(monkeypatch, ttl_seconds=60)
+    cache.put(*PERSONA, 'Then I', 'walked to the store.')
+    clock.now += 59
+    assert cache.get(*PERSONA, 'Then I') == 'walked to the store.'
+    clock.now += 2
+    assert cache.get(*PERSONA, 'Then I') is None
+    assert cache.get(*PERSONA, 'Then I walked') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch):
+    cache, _ = make_cache(monkeypatch, max_entries=2)
+    cache.put(*PERSONA, 'A', 'first.')
+    cache.put(*PERSONA, 'B', 'second.')
+    assert cache.get(*PERSONA, 'A') == 'first.'  # B is now the least recently used
+    cache.put(*PERSONA, 'C', 'third.')
+    assert cache.get(*PERSONA, 'B') is None
+    assert cache.get(*PERSONA, 'A') == 'first.'
+    assert cache.get(*PERSONA, 'C') == 'third.'
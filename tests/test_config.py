@@ -0,0 +1,41 @@
+"""
+Startup checks for AppConfig. Run from the repository root with `python -m pytest tests`.
+"""
+
+import os
+
+import yaml
+
+from config import AppConfig
+
+REPO_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.yaml')
+
+
+def write_config(tmp_path, **overrides):
+    with open(REPO_CONFIG) as f:
+        config = yaml.safe_load(f)
+    config.update(overrides)
+    path = tmp_path / 'config.yaml'
+    path.write_text(yaml.safe_dump(config))
+    return str(path)
+
+
+def test_experiment_mode_starts_without_a_character(tmp_path, monkeypatch):
+    # Each participant's event effects come from their persona job, so startup makes no LLM call
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('LLM_BACKEND', 'fake')
+    app_config = AppConfig(write_config(tmp_path, enable_experiment=True, hardcode_character_and_event=False))
+    assert app_config.event['name']
+    assert app_config.event_description is None
+
+
+def test_admission_limits_are_split_between_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('LLM_BACKEND', 'fake')
+    monkeypatch.setenv('WEB_CONCURRENCY', '4')
+    monkeypatch.setenv('FLASK_SECRET_KEY', 'test')
+    app_config = AppConfig(write_config(tmp_path, admission={
+        'enabled': True, 'requests_per_minute': 4000, 'tokens_per_minute': 800000, 'burst_seconds': 5,
+        'per_session': 1, 'min_remaining_seconds': 0.3}))
+    assert app_config.admission_requests_per_minute == 1000
+    assert app_config.admission_tokens_per_minute == 200000
@@ -0,0 +1,119 @@
+"""
+CompletionDispatcher and its circuit breaker, with a stand-in for the LLM call. Run from the repository root with
+`python -m pytest tests`.
+"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import dispatch
+from admission import BATCH, INTERACTIVE
+from dispatch import CircuitBreaker, CompletionDispatcher
+
+MESSAGES = [{'role': 'user', 'content': 'Finish: I walked'}]
+
+
+def response(text):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def slow_completion(calls, seconds, started=None):
+    lock = threading.Lock()
+
+    def completion(model, **kwargs):
+        with lock:
+            calls.append(model)
+            if started is not None:
+                started.append(time.monotonic())
+        time.sleep(seconds)
+        return response('home.')
+
+    return completion
+
+
+def test_breaker_opens_after_the_failure_threshold(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dispatch, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=30)
+    for _ in range(2):
+        breaker.record('m', False)
+    assert breaker.allow('m')
+    breaker.record('m', True)  # A success resets the count
+    for _ in range(3):
+        breaker.record('m', False)
+    assert not breaker.allow('m')
+    assert breaker.open_models() == ['m']
+    assert breaker.allow('other')
+
+
+def test_breaker_lets_one_trial_through_after_the_reset_time(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dispatch, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record('m', False)
+    clock.now += 29
+    assert not breaker.allow('m')
+    clock.now += 2
+    assert breaker.allow('m')  # Half open: one trial call
+    assert not breaker.allow('m')  # Others wait for the trial
+    breaker.record('m', False)  # The trial failed: open again
+    clock.now += 29
+    assert not breaker.allow('m')
+    clock.now += 2
+    assert breaker.allow('m')
+    breaker.record('m', True)  # The trial succeeded: closed
+    assert breaker.allow('m') and breaker.allow('m')
+
+
+def test_dispatcher_skips_a_model_whose_breaker_is_open():
+    dispatcher = CompletionDispatcher(breaker=CircuitBreaker(failure_threshold=1), hedge_model='backup')
+    dispatcher.record('m', False)
+    assert dispatcher.pick_model('m') == 'backup'
+    dispatcher.record('backup', False)
+    assert dispatcher.pick_model('m') is None
+
+
+def test_hedge_is_sent_only_after_the_hedge_delay(monkeypatch):
+    calls, started = [], []
+    monkeypatch.setattr(dispatch, 'completion', slow_completion(calls, 0.4, started))
+    dispatcher = CompletionDispatcher(deadline_seconds=2, hedge_default_delay=0.2)
+    assert dispatcher.complete('m', MESSAGES, 1.0, 10) == ['home.']
+    assert len(started) == 2 and started[1] - started[0] >= 0.2
+    assert dispatcher.hedges == 1
+
+
+def test_no_hedge_when_the_call_answers_before_the_hedge_delay(monkeypatch):
+    calls = []
+    monkeypatch.setattr(dispatch, 'completion', slow_completion(calls, 0.05))
+    dispatcher = CompletionDispatcher(deadline_seconds=2, hedge_default_delay=0.3)
+    assert dispatcher.complete('m', MESSAGES, 1.0, 10) == ['home.']
+    assert calls == ['m'] and dispatcher.hedges == 0
+
+
+def test_hedge_delay_follows_the_latency_percentile():
+    dispatcher = CompletionDispatcher(hedge_percentile=90, hedge_default_delay=1.0, min_samples=10)
+    for latency in range(9):
+        dispatcher.record('m', True, latency / 10)
+    assert dispatcher.hedge_delay('m') == 1.0  # Too few samples yet
+    for latency in range(9, 20):
+        dispatcher.record('m', True, latency / 10)
+    assert dispatcher.hedge_delay('m') == 1.8
+
+
+def test_batch_calls_are_not_hedged(monkeypatch):
+    calls = []
+    monkeypatch.setattr(dispatch, 'completion', slow_completion(calls, 0.3))
+    dispatcher = CompletionDispatcher(deadline_seconds=2, hedge_default_delay=0.05)
+    assert dispatcher.complete('m', MESSAGES, 1.0, 10, priority=BATCH) == ['home.']
+    assert calls == ['m'] and dispatcher.hedges == 0
+    assert dispatcher.complete('m', MESSAGES, 1.0, 10, priority=INTERACTIVE) == ['home.']
+    assert dispatcher.hedges == 1
@@ -0,0 +1,69 @@
+"""
+The incremental document split and the context window built from it. Run from the repository root with
+`python -m pytest tests`.
+"""
+
+import random
+
+from context_window import ContextWindow
+from documents import Document
+from text_processing import normalize_spacing, split_sentences
+
+ALPHABET = 'ab c.!?  [\n]'
+WORDS = 'I went to the store and bought some milk. Then I came home! Was it late? Yes.'.split()
+
+
+def random_text(rng, max_length):
+    return ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, max_length)))
+
+
+def test_edits_give_the_split_and_sentences_of_a_fresh_document():
+    rng = random.Random(0)
+    for _ in range(500):
+        document = Document(random_text(rng, 30))
+        for _ in range(10):
+            offset = rng.randint(0, len(document.text))
+            document.apply(document.version, offset, rng.randint(0, len(document.text) - offset),
+                           random_text(rng, 4))
+            fresh = Document(document.text)
+            assert document.context_and_incomplete_sentence() == fresh.context_and_incomplete_sentence()
+            context = document.context_and_incomplete_sentence()[0]
+            assert document.sentences(context) == tuple(normalize_spacing(s) for s in split_sentences(context))
+
+
+def test_sentences_cover_a_context_extended_by_a_suggestion():
+    document = Document('I woke up late. Then I')
+    assert document.sentences('I woke up late. Then I ran. And') == ('I woke up late.', 'Then I ran.', 'And')
+    assert document.sentences('I slept in.') is None
+
+
+def test_window_from_document_sentences_matches_a_full_split():
+    rng = random.Random(0)
+    split_window = ContextWindow(lambda summary, text: 'Summary.', max_prompt_tokens=60, verbatim_sentences=3)
+    document_window = ContextWindow(lambda summary, text: 'Summary.', max_prompt_tokens=60, verbatim_sentences=3)
+    document = Document()
+    for _ in range(300):
+        document.apply(document.version, len(document.text), 0, ' ' + rng.choice(WORDS))
+        if rng.random() < 0.05:
+            document.apply(document.version, 0, 3, '')  # An edit early in the text
+        context = document.context_and_incomplete_sentence()[0]
+        assert (split_window.build('s', context, 10)
+                == document_window.build('s', context, 10, document.sentences(context)))
+        split_window.flush()
+        document_window.flush()
+
+
+def test_one_off_window_summarizes_right_away_and_keeps_nothing():
+    calls = []
+
+    def summarize(previous_summary, new_text):
+        calls.append(new_text)
+        return 'Summary.'
+
+    window = ContextWindow(summarize, max_prompt_tokens=60, verbatim_sentences=3)
+    context = ' '.join(f'Sentence number {i} is about the rain.' for i in range(20))
+    prompt_context, _ = window.build(None, context, 10)
+    assert len(calls) == 1
+    assert prompt_context.startswith('(Summary of what I wrote earlier: Summary.)')
+    assert prompt_context.endswith('Sentence number 19 is about the rain.')
+    assert not window._sessions
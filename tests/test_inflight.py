@@ -0,0 +1,73 @@
+"""
+Supersession of in-flight requests in InflightTracker. Run from the repository root with `python -m pytest tests`.
+"""
+
+import threading
+
+from inflight import InflightTracker
+
+
+def run_in_thread(tracker, sid, fn, *args, **kwargs):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(tracker.run(sid, fn, *args, **kwargs)))
+    thread.start()
+    return thread, results
+
+
+def test_newer_request_makes_the_older_one_stale_and_discards_its_result():
+    tracker = InflightTracker(max_workers=4)
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_call():
+        started.set()
+        release.wait(5)
+        return 'old suggestion'
+
+    thread, old = run_in_thread(tracker, 's', slow_call)
+    assert started.wait(1)
+    request_id, result, stale = tracker.run('s', lambda: 'new suggestion')
+    thread.join(1)  # The older request returns right away, without waiting for its call
+    assert not thread.is_alive()
+    assert old[0][1:] == (None, True)
+    assert (result, stale) == ('new suggestion', False)
+    assert request_id == old[0][0] + 1
+    release.set()
+    assert tracker.stats()['superseded'] == 1
+
+
+def test_requests_of_other_sessions_do_not_supersede_each_other():
+    tracker = InflightTracker(max_workers=4)
+    release = threading.Event()
+    thread, first = run_in_thread(tracker, 'a', lambda: release.wait(5) and 'a suggestion')
+    assert tracker.run('b', lambda: 'b suggestion')[1:] == ('b suggestion', False)
+    release.set()
+    thread.join(1)
+    assert first[0][1:] == ('a suggestion', False)
+
+
+def test_finished_request_is_not_counted_as_superseded():
+    tracker = InflightTracker(max_workers=2)
+    tracker.run('s', lambda: 'first')
+    tracker.run('s', lambda: 'second')
+    assert tracker.stats()['superseded'] == 0
+
+
+def test_cancel_by_client_request_id():
+    tracker = InflightTracker(max_workers=4)
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_call():
+        started.set()
+        release.wait(5)
+        return 'suggestion'
+
+    thread, results = run_in_thread(tracker, 's', slow_call, client_request_id='r1')
+    assert started.wait(1)
+    assert not tracker.cancel('s', 'r0')  # Not the request in flight
+    assert tracker.cancel('s', 'r1')
+    thread.join(1)
+    assert results[0][1:] == (None, True)
+    release.set()
+    assert not tracker.cancel('s', 'r1')  # Already cancelled
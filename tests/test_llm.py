@@ -0,0 +1,34 @@
+"""
+LLM call plumbing in llm.py. Run from the repository root with `python -m pytest tests`.
+"""
+
+import asyncio
+import inspect
+import time
+
+from llm import CallSetupExecutor
+
+
+def test_call_setup_executor_closes_the_coroutine_of_a_cancelled_call():
+    built = []
+
+    async def request():
+        return 'sent'
+
+    def build_call():
+        time.sleep(0.1)
+        built.append(request())
+        return built[-1]
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(CallSetupExecutor(max_workers=1))
+        call = asyncio.ensure_future(loop.run_in_executor(None, build_call))
+        await asyncio.sleep(0.02)  # The coroutine is being built
+        call.cancel()
+        await asyncio.sleep(1.3)
+        assert inspect.getcoroutinestate(built[0]) == inspect.CORO_CLOSED
+        assert await loop.run_in_executor(None, build_call) is built[1]
+        assert await built[1] == 'sent'
+
+    asyncio.run(scenario())
@@ -0,0 +1,157 @@
+"""
+Differential check of the completion post-processing in text_processing.py: on random completions it must return
+exactly what the original implementation returned. Run from the repository root with `python -m pytest tests`, or on
+its own with more cases:
+    python -m tests.test_postprocess --cases 200000
+"""
+
+import argparse
+import random
+import re
+import string
+
+from text_processing import (postprocess_completion, normalize_spacing, remove_duplicated_completion,
+                             get_context_and_incomplete_sentence)
+
+PIECES = (['the', 'The', 'bus', 'stop', 'rain', 'I', 'walked', 'home', 'mil', 'milk', 'EVENT', 'EFFECTS', 'CONTEXT',
+           'INSTRUCTIONS', 'INCOMPLETE SENTENCE', 'CHARACTER DESCRIPTION', 'EVENTS', 'café', 'İstanbul', 'ß']
+          + list(string.punctuation) + [' ', '  ', '\t', '\n', '\xa0', ' ', '　', '\x1c', '\r\n'])
+
+
+# The original functions, kept verbatim as the reference for the differential check
+
+def legacy_postprocess_completion(incomplete_sentence, completion):
+    if completion is None:
+        completion = ''
+    completion_no_prompt = legacy_remove_prompt_words(completion)
+    full_word_completion = legacy_normalize_spacing(legacy_extract_complete_words(completion_no_prompt))
+    de_duped_completion = legacy_normalize_spacing(legacy_remove_duplicated_completion(incomplete_sentence,
+                                                                                       full_word_completion))
+    return {'completion': completion, 'completion_no_prompt': completion_no_prompt,
+            'full_word_completion': full_word_completion, 'de_duped_completion': de_duped_completion}
+
+
+def legacy_remove_duplicated_completion(incomplete_sentence, completion):
+    if not incomplete_sentence or not completion:
+        return completion
+    incomplete_sentence = incomplete_sentence.strip()
+    completion = completion.strip()
+    if completion.startswith(incomplete_sentence):
+        return completion[len(incomplete_sentence):].lstrip()
+    elif completion.lower().startswith(incomplete_sentence.lower()):
+        return completion[len(incomplete_sentence):].lstrip()
+    elif incomplete_sentence.endswith(completion):
+        return ""
+    else:
+        for i in range(len(completion)):
+            if incomplete_sentence.endswith(completion[:i]):
+                return completion[i:].lstrip()
+        return completion
+
+
+def legacy_normalize_spacing(text):
+    if text is None:
+        return None
+    text = text.replace(u'\xa0', ' ').replace('\t', ' ')
+    text = re.sub(r'\s+', ' ', text)
+    text = text.strip()
+    return text
+
+
+def legacy_remove_prompt_words(text):
+    bad_words = ['INSTRUCTIONS', 'CONTEXT', 'INCOMPLETE SENTENCE', 'CHARACTER DESCRIPTION', 'EVENT', 'EVENT EFFECTS']
+    pattern = re.compile(r'\b(' + '|'.join(map(re.escape, bad_words)) + r')\b')
+    text = pattern.sub('', text)
+    return text
+
+
+def legacy_get_context_and_incomplete_sentence(text):
+    sentence_terminators = r"[.!?]"
+    sentences = re.split('({})'.format(sentence_terminators), text)
+    sentences = [sentences[i] + (sentences[i + 1] if i + 1 < len(sentences) else '') for i in
+                 range(0, len(sentences), 2)]
+    if len(sentences) == 1:
+        if text.endswith(tuple(sentence_terminators)):
+            return sentences[0].strip(), ''
+        else:
+            return '', sentences[0].strip()
+    else:
+        if text.endswith(tuple(sentence_terminators)):
+            context = ' '.join(sentences)
+            incomplete_sentence = ""
+        else:
+            context = ' '.join(sentences[:-1])
+            incomplete_sentence = sentences[-1]
+    return context.strip(), incomplete_sentence.strip()
+
+
+def legacy_extract_complete_words(text):
+    if not text:
+        return text
+    words = text.split()
+    if not words:
+        return text
+    if text[-1] in string.whitespace + string.punctuation:
+        return text
+    else:
+        return ' '.join(words[:-1])
+
+
+def make_text(rng, n_pieces):
+    return ''.join(rng.choice(PIECES) + rng.choice(['', ' ']) for _ in range(n_pieces))
+
+
+def make_case(rng, n_pieces):
+    """An (incomplete sentence, completion) pair, often with the completion repeating part of the sentence."""
+    incomplete_sentence = make_text(rng, rng.randint(0, 12))
+    completion = make_text(rng, n_pieces)
+    overlap = rng.random()
+    if overlap < 0.2:
+        completion = incomplete_sentence + completion
+    elif overlap < 0.3:
+        completion = incomplete_sentence.upper() + completion
+    elif overlap < 0.4:
+        completion = incomplete_sentence[rng.randint(0, len(incomplete_sentence)):]
+    elif overlap < 0.5:
+        completion = incomplete_sentence[rng.randint(0, len(incomplete_sentence)):] + completion
+    return normalize_spacing(incomplete_sentence), completion
+
+
+def check(rng, n_cases):
+    mismatches = 0
+    for _ in range(n_cases):
+        incomplete_sentence, completion = make_case(rng, rng.randint(0, 40))
+        checks = [
+            (postprocess_completion(incomplete_sentence, completion),
+             legacy_postprocess_completion(incomplete_sentence, completion)),
+            (postprocess_completion(incomplete_sentence, normalize_spacing(completion)),
+             legacy_postprocess_completion(incomplete_sentence, legacy_normalize_spacing(completion))),
+            (remove_duplicated_completion(incomplete_sentence, completion),
+             legacy_remove_duplicated_completion(incomplete_sentence, completion)),
+            (get_context_and_incomplete_sentence(completion), legacy_get_context_and_incomplete_sentence(completion)),
+        ]
+        for new, old in checks:
+            if new != old:
+                mismatches += 1
+                if mismatches <= 5:
+                    print(f"MISMATCH for {incomplete_sentence!r}, {completion!r}:\n  new {new!r}\n  old {old!r}")
+    return mismatches
+
+
+def test_postprocess_matches_the_original_implementation():
+    assert check(random.Random(0), 5000) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', type=int, default=20000, help='Random cases to check')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    mismatches = check(random.Random(args.seed), args.cases)
+    print(f"differential check: {args.cases} cases, {mismatches} mismatches")
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Pure text processing for autocomplete: splitting the user's text into context and the sentence to complete, and
+cleaning up what the LLM returns.
+"""
+
+import re
+import string
+
+# Prompt section headers the LLM sometimes echoes back
+PROMPT_WORDS = re.compile(r'\b(' + '|'.join(map(re.escape, ['INSTRUCTIONS', 'CONTEXT', 'INCOMPLETE SENTENCE',
+                                                             'CHARACTER DESCRIPTION', 'EVENT', 'EVENT EFFECTS']))
+                          + r')\b')
+SENTENCE_SPLIT = re.compile(r'([.!?])')
+WORD_BOUNDARY = frozenset(string.whitespace + string.punctuation)
+
+
+def stream_complete_words(incomplete_sentence, chunks):
+    """
+    Runs the post-processing chain incrementally over a stream of LLM chunks. Yields (delta, raw) where `delta` is
+    the text that became final since the last yield and `raw` is everything received so far.
+    """
+    words = CompleteWordStream(incomplete_sentence)
+    for chunk in chunks:
+        delta = words.push(chunk)
+        if delta:
+            yield delta, words.raw
+    yield '', words.raw
+
+
+class CompleteWordStream:
+    """
+    Incremental state behind `stream_complete_words`, usable from sync and async streams alike.
+
+    The chain is only re-run when a chunk contains a word boundary, since `extract_complete_words` drops the trailing
+    word otherwise. Output is held back while it could still turn out to be a repeat of the incomplete sentence
+    (which `remove_duplicated_completion` would strip once the full overlap arrives).
+    """
+    boundary_chars = WORD_BOUNDARY
+
+    def __init__(self, incomplete_sentence):
+        self.incomplete_sentence = incomplete_sentence
+        self.raw = ''
+        self.emitted = ''
+
+    def push(self, chunk):
+        """Add a chunk. Returns the newly completed text, or '' if nothing new is final yet."""
+        self.raw += chunk
+        if not self.boundary_chars.intersection(chunk):
+            return ''
+        processed = postprocess_completion(self.incomplete_sentence,
+                                           normalize_spacing(self.raw))['de_duped_completion']
+        if not processed or self.incomplete_sentence.lower().startswith(processed.lower()):
+            return ''
+        if processed.startswith(self.emitted) and len(processed) > len(self.emitted):
+            delta = processed[len(self.emitted):]
+            self.emitted = processed
+            return delta
+        return ''
+
+
+def postprocess_completion(incomplete_sentence, completion):
+    """
+    Clean a raw LLM completion. Returns every intermediate string so callers can log them.
+
+    Same result as chaining remove_prompt_words, extract_complete_words, remove_duplicated_completion and
+    normalize_spacing, but splits the completion into words once and skips the normalizing passes that cannot change
+    an already normalized string.
+    """
+    if completion is None:
+        completion = ''
+    completion_no_prompt = PROMPT_WORDS.sub('', completion)
+    words = completion_no_prompt.split()
+    if words and completion_no_prompt[-1] not in WORD_BOUNDARY:
+        words.pop()  # See extract_complete_words
+    full_word_completion = ' '.join(words)
+    de_duped_completion = remove_duplicated_completion(incomplete_sentence, full_word_completion)
+    return {'completion': completion, 'completion_no_prompt': completion_no_prompt,
+            'full_word_completion': full_word_completion, 'de_duped_completion': de_duped_completion}
+
+
+def rank_candidates(incomplete_sentence, completions):
+    """
+    Post-process several raw completions for the same request and return the distinct, non-empty suggestions, longest
+    first (the post-processing only ever shortens a completion, so longer ones lost less). Ties keep their order.
+    """
+    seen = set()
+    candidates = []
+    for completion in completions:
+        candidate = postprocess_completion(incomplete_sentence, normalize_spacing(completion))['de_duped_completion']
+        if candidate and candidate.lower() not in seen:
+            seen.add(candidate.lower())
+            candidates.append(candidate)
+    return sorted(candidates, key=lambda candidate: -len(candidate.split()))
+
+
+def remove_duplicated_completion(incomplete_sentence, completion):
+    if not incomplete_sentence or not completion:
+        return completion
+
+    incomplete_sentence = incomplete_sentence.strip()
+    completion = completion.strip()
+
+    # Case 1: Direct overlap
+
+    # Case 1a (same case):
+    if completion.startswith(incomplete_sentence):
+        return completion[len(incomplete_sentence):].lstrip()
+    # Case 1b (different case):
+    elif completion.lower().startswith(incomplete_sentence.lower()):
+        return completion[len(incomplete_sentence):].lstrip()
+
+    # Case 2: Completion is a subset of incomplete
+    elif incomplete_sentence.endswith(completion):
+        return ""
+
+    # Case 3 (non direct overlap) used to scan every prefix of the completion, shortest first. The empty prefix always
+    # matches, so it returned the completion unchanged, as does Case 4 (no overlap).
+    return completion
+
+
+def normalize_spacing(text):
+    """Collapse every run of whitespace (including non-breaking spaces and tabs) to one space, and strip the ends."""
+    if text is None:
+        return None
+    return ' '.join(text.split())
+
+
+def remove_prompt_words(text):
+    """Remove any prompt wods that LLM accidently included in answer"""
+    return PROMPT_WORDS.sub('', text)
+
+
+def get_context_and_incomplete_sentence(text):
+    """
+    We feed into the model both the prior context for what was written and the current
+    sentence to complete. This function splits those things.
+    """
+    sentence_terminators = r"[.!?]"
+    sentences = SENTENCE_SPLIT.split(text)
+    sentences = [sentences[i] + (sentences[i + 1] if i + 1 < len(sentences) else '') for i in
+                 range(0, len(sentences), 2)]
+
+    if len(sentences) == 1:
+        # Single sentence which could be complete or incomplete
+        if text.endswith(tuple(sentence_terminators)):
+            return sentences[0].strip(), ''
+        else:
+            return '', sentences[0].strip()
+    else:
+        if text.endswith(tuple(sentence_terminators)):
+            context = ' '.join(sentences)
+            incomplete_sentence = ""
+        else:
+            context = ' '.join(sentences[:-1])
+            incomplete_sentence = sentences[-1]
+
+    return context.strip(), incomplete_sentence.strip()
+
+
+def split_sentences(text):
+    """Split text into sentences, each keeping its terminator, the same way get_context_and_incomplete_sentence does."""
+    pieces = SENTENCE_SPLIT.split(text)
+    sentences = [pieces[i] + (pieces[i + 1] if i + 1 < len(pieces) else '') for i in range(0, len(pieces), 2)]
+    return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+
+def extract_complete_words(text):
+    """
+    Extracts complete words from the given text since sometimes the LLM returns
+    incomplete words depending on tokens. But in practice, it is expensive to accurately check if a word is complete,
+    so a simple heuristic is used:
+
+    - If the immediate character before the last word is whitespace or punctuation, then the word is necessarily complete.
+    - If the word is not necessarily complete, then it is assumed to be incomplete.
+    - Note: This means in practice we often just delete the last word of the completion.
+
+    EXAMPLES
+    "I went to the store to buy some mil" -> "I went to the store to buy some"
+    "I went to the store to buy some milk" -> "I went to the store to buy some"
+
+    """
+    if not text:
+        return text
+    words = text.split()
+    if not words:
+        return text
+    if text[-1] in WORD_BOUNDARY:
+        return text
+    else:
+        return ' '.join(words[:-1])